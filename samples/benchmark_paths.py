@@ -0,0 +1,38 @@
+# encoding: utf-8
+__author__ = 'Marko Čibej'
+
+
+import sys
+import timeit
+import random
+from svgmapper.svgfig_mc import Path, PathData
+
+
+# A few shapes of path data that come out of real maps: long absolute polylines, implicit linetos after a moveto,
+# compact relative data with no separators, and curves.
+random.seed(0)
+_coordinates = [(random.uniform(-500, 500), random.uniform(-500, 500)) for i in xrange(20000)]
+_paths = {
+    'absolute lines': 'M 0,0 ' + ' '.join('L {:.4f},{:.4f}'.format(x, y) for x, y in _coordinates) + ' Z',
+    'implicit lines': 'M0,0 ' + ' '.join('{:.4f},{:.4f}'.format(x, y) for x, y in _coordinates) + 'z',
+    'compact relative': 'm0,0' + ''.join('l{:.2f}{:+.2f}'.format(x / 100, y / 100) for x, y in _coordinates) + 'z',
+    'curves': 'M0,0' + ''.join('C{:.3f},{:.3f} {:.3f},{:.3f} {:.3f},{:.3f}'.format(
+        *(_coordinates[i] + _coordinates[i + 1] + _coordinates[i + 2])) for i in xrange(0, 19998, 3)),
+}
+
+
+repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+print u'Parsing'
+for name in sorted(_paths):
+    d = _paths[name]
+    best = min(timeit.repeat(lambda: Path(d), number=1, repeat=repeat))
+    print u'{:>20}: {:>9} bytes, {:>6} segments, {:.4f} s, {:.1f} MB/s'.format(
+        name, len(d), len(Path(d).d), best, len(d) / best / 1e6)
+
+print u'Writing, with the default %g, with precision 2 and with precision 2 in relative commands'
+for name in sorted(_paths):
+    p = Path(PathData(_paths[name]))
+    for options in [(None, False), (2, False), (2, True)]:
+        best = min(timeit.repeat(lambda: p.SVG(None, *options), number=1, repeat=repeat))
+        print u'{:>20} {:>14}: {:>9} bytes, {:.4f} s'.format(
+            name, options, len(p.SVG(None, *options).attr['d']), best)
@@ -0,0 +1,126 @@
+# encoding: utf-8
+__author__ = 'Marko Čibej'
+
+
+import sys
+import random
+from math import pi, sin, cos, asin, radians
+import numpy as np
+from svgmapper.projections import projection_classes, Rotation, inverse_residual
+from svgmapper.resources import Projection, Rectangle, Transform
+
+
+# Round trips of unproject after project for every projection class, the variants with their own inverse, the whole
+# resources.Projection with central meridian, aspect and rotation, and a Transform between page coordinates. A point
+# passes if it comes back to within tolerance of where it started: on the unit sphere, as the straight distance
+# between the two points, and on the page, in page units.
+tolerance = 1e-9
+
+y_ref, y_0, y_1 = radians(30), radians(20), radians(60)
+cutoff = radians(80)
+
+# Each case is a label, a class name, its parameters and a test that the point is one the class can take back; the
+# test gets the coordinates as they reach the class, after any change of aspect.
+_everywhere = lambda x, y: True
+_cases = [(name, name, {}, _everywhere) for name in sorted(projection_classes)
+          if name not in ('Cylindrical', 'Gnomonic', 'Mercator')]
+_cases += [
+    ('Cylindrical Plate-Carree', 'Cylindrical', {'variant': 'Plate-Carree'}, _everywhere),
+    # the Lambert and central cylindricals only reach 90 degrees either side of the reference parallel
+    ('Cylindrical Lambert', 'Cylindrical', {'variant': 'Lambert'}, lambda x, y: abs(y - y_ref) < radians(89)),
+    ('Cylindrical Central', 'Cylindrical', {'variant': 'Central'}, lambda x, y: abs(y - y_ref) < radians(80)),
+    # the gnomonic shows less than the hemisphere around (0, y_ref)
+    ('Gnomonic', 'Gnomonic', {}, lambda x, y: sin(y_ref)*sin(y) + cos(y_ref)*cos(y)*cos(x) > cos(radians(80))),
+]
+# Points beyond the Mercator cutoff are clipped to it, so they can't come back; the cutoff applies to the latitude
+# on the turned sphere, and the transverse and oblique Mercator are normal Mercator on it turned sideways
+for label, d, pole in [('Mercator', {}, None), ('Mercator transverse', {'transverse': True}, (pi/2, 0)),
+                       ('Mercator oblique', {'oblique': [radians(20), radians(60)]}, (radians(20), radians(60)))]:
+    aspect = Rotation(*pole) if pole else None
+    d['cutoff'] = 80
+    _cases.append((label, 'Mercator', d,
+                   lambda x, y, aspect=aspect: abs(aspect.rotate(x, y)[1] if aspect else y) < cutoff))
+
+
+def sphere_distance(x0, y0, x1, y1):
+    """ The straight distance between two points on the unit sphere, which doesn't care about a wrapped longitude. """
+    u0, v0, w0 = np.cos(y0)*np.cos(x0), np.cos(y0)*np.sin(x0), np.sin(y0)
+    u1, v1, w1 = np.cos(y1)*np.cos(x1), np.cos(y1)*np.sin(x1), np.sin(y1)
+    return np.sqrt((u1 - u0)**2 + (v1 - v0)**2 + (w1 - w0)**2)
+
+
+def sample(test, n, align=None):
+    """ n random points of the whole sphere, short of the poles, that pass the test after an optional alignment. """
+    xs, ys = [], []
+    while len(xs) < n:
+        x, y = random.uniform(-pi + 1e-3, pi - 1e-3), asin(random.uniform(-0.9995, 0.9995))
+        if test(*(align(x, y) if align else (x, y))):
+            xs.append(x)
+            ys.append(y)
+    return np.array(xs), np.array(ys)
+
+
+def report(name, errors, limit):
+    worst = np.max(errors)
+    ok = worst <= limit
+    print u'{:>44}: {:>5} points, worst {:.2e}  {}'.format(name, len(errors), worst, 'ok' if ok else 'FAILED')
+    return ok
+
+
+class _Host:
+    """ All that Projection.initialize needs of a map: the world rectangle, here the whole world. """
+    rect_world_rad = Rectangle([-pi, -pi/2, pi, pi/2])
+
+
+random.seed(0)
+passed = True
+
+print u'Projection classes, scalar and vectorized, in radians'
+for label, name, d, test in _cases:
+    p = projection_classes[name](y_ref, y_0, y_1, dict(d))
+    x, y = sample(test, 2000)
+    back = np.array([p.unproject(*p.project(*_)) for _ in zip(x, y)])
+    passed &= report(label + ' scalar', sphere_distance(x, y, back[:, 0], back[:, 1]), tolerance)
+    bx, by = p.unproject_many(*p.project_many(x, y))
+    passed &= report(label + ' vectorized', sphere_distance(x, y, bx, by), tolerance)
+
+print u'resources.Projection with central meridian, aspect and rotation, in radians'
+# the standard parallels are taken as they are, in radians
+_parameters = {'reference-parallel': 30, 'standard-parallel-1': y_0, 'standard-parallel-2': y_1}
+for label, name, d, test in _cases:
+    d = dict(d, **{'class': name, 'central-meridian': 10, 'rotate': 15})
+    d.update(_parameters)
+    if name != 'Mercator':
+        d['aspect'] = [20, 60]
+    p = Projection(d).initialize(_Host())
+    x, y = sample(test, 2000, p.align)
+    bx, by = p.unproject_many(*p.project_many(x, y))
+    passed &= report(label + ' unproject_many', sphere_distance(x, y, bx, by), tolerance)
+
+print u'Transform from page to page and back, in page units'
+for label, name, d, test in _cases:
+    d = dict(d, **{'class': name})
+    d.update(_parameters)
+    if name != 'Mercator':
+        d['aspect'] = [20, 60]
+    p = Projection(d).initialize(_Host())
+    # the page is 720 by 360 units for the whole world, upside down; the output is scaled by 100
+    dx = 2*pi/720
+    t = Transform(p, (dx, -dx, -pi, pi/2), (100.0, 0.0, 0.0, 400.0, 200.0))
+    x, y = sample(lambda x, y: test(*p.align(x, y)), 2000)
+    x, y = (x + pi)/dx, (y - pi/2)/-dx
+    bx, by = t.unproject_many(*t.project_many(x, y))
+    passed &= report(label + ' run_inverse_many', np.hypot(bx - x, by - y), tolerance/dx)
+
+print u'Winkel-Tripel: a point outside the projected world does not converge and comes back as nan'
+w = projection_classes['Winkel-Tripel'](y_ref, y_0, y_1, {})
+outside = w.unproject(3.0, 2.0), w.unproject_many(np.array([3.0, w.project(1.0, 0.5)[0]]),
+                                                  np.array([2.0, w.project(1.0, 0.5)[1]]))
+converged = np.isnan(outside[0]).all() and np.isnan(outside[1][0][0]) and np.isnan(outside[1][1][0]) and \
+    abs(outside[1][0][1] - 1.0) <= tolerance and abs(outside[1][1][1] - 0.5) <= tolerance
+print u'{:>44}: {}  (residual limit {:.0e})'.format('nan outside, inside solved', 'ok' if converged else 'FAILED',
+                                                    inverse_residual)
+passed &= converged
+
+print u'All round trips within {:.0e}'.format(tolerance) if passed else u'Some round trips FAILED'
+sys.exit(0 if passed else 1)
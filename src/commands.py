@@ -78,6 +78,8 @@ class Project(Command):
     """
 
     content_types = {'paths': 'path', 'texts': 'text', 'marks': 'g'}
+    # paths with fewer points are projected point by point, which is faster than setting up a vectorized call
+    many_points = 64
 
     def __init__(self, d):
         Command.__init__(self, d)
@@ -95,54 +97,90 @@ class Project(Command):
         """
         Select the matching items and project them to the output file.
         """
+        self.prepare(the_map)
+        for p in self.match.iter(the_map.input_svg, the_map.index):
+            projected = self.project_one(the_map, p)
+            if projected is None:
+                continue
+            pp, affine = projected
+            if affine:
+                the_map.add_affine(self.target, pp)
+            else:
+                the_map.add_to_layer(self.target, pp)
+        logger.info(u'Project.run: finished mapping: {}'.format(self.what))
+
+    def prepare(self, the_map):
+        """
+        Resolve the style, the match and the replacement symbol.
+        """
         self.style = self.require_style(self.style, the_map)
         self.match = self.require_match(self.match, the_map)
         self.match.set_svg_type(self.content_types[self.what])
         if self.replacement is not None:
             self.replacement = the_map.get_symbol(self.replacement)
 
-        for p in self.match.iter(the_map.input_svg):
-            #TODO: handle multiple and nested transforms.
-            pp = p.clone()
-            if pp.t == 'path':
-                # Paths are easy, since svgfig does most of the work for us
-                # Caution: any svg transformations are passed on unchanged
-                # (although the style attribute could be used in a sneaky way to override that)
-                if the_map.clip(pp):
-                    continue
-                self.style.apply(pp)
-                pp = svgfig_mc.pathtoPath(pp).SVG(the_map.project)
-            elif pp.t == 'text':
-                # for texts, we have to consider existing transforms
-                try:
-                    x, y = float(pp.attr['x']), float(pp.attr['y'])
-                except KeyError:
-                    logger.error('Project.run: skipping text element {} without coordinates.'.format(pp.attr['id']))
-                    continue
-                m = svg_get_matrix(get_or_default(pp.attr, 'transform', ''))
-                x0, y0 = m[0]*x + m[2]*y + m[4], m[1]*x + m[3]*y + m[5]
-                if the_map.clip((x0, y0)):
-                    continue
-                x1, y1 = the_map.project(x0, y0)
-                m[4] += x1 - x0
-                m[5] += y1 - y0
-                pp.attr['transform'] = 'matrix({:f},{:f},{:f},{:f},{:f},{:f})'.format(*m)
-            elif pp.t == 'g':
-                # For markers, the Symbol class together with svg_transform
-                # does most of the work of sizing, centering and placing the symbol
-                #TODO: change the logic: a symbol is anything that matches the selection criteria
-                x0, y0 = svg_center(pp)
-                if the_map.clip((x0, y0)):
-                    continue
-                x1, y1 = the_map.project(x, y)
-                if self.replacement:
-                    pp = svg_transform(self.replacement.get_svg(), self.replacement.anchor[0],
-                                       self.replacement.anchor[1], x1, y1, self.replacement.scale,
-                                       self.replacement.scale)
-                else:
-                    pp = svg_transform(pp, x, y, x1, y1)
-            the_map.add_to_layer(self.target, pp)
-        logger.info(u'Project.run: finished mapping: {}'.format(self.what))
+    def project_one(self, the_map, p):
+        """
+        Project a single matching item. Returns the projected copy and whether it still needs the map's affine
+        transformation, or None if the item is clipped or skipped.
+        """
+        #TODO: handle multiple and nested transforms.
+        if p.t == 'path':
+            # parse the input element rather than its clone, so that the parsed path stays with the input
+            # and the clone shares it
+            p.pathdata()
+            if the_map.clip(p):
+                return None
+        # only the attributes of the copy are changed, so its content can be shared with the input
+        pp = p.clone(cow=True)
+        if pp.t == 'path':
+            # Paths are easy, since svgfig does most of the work for us
+            # Caution: any svg transformations are passed on unchanged
+            # (although the style attribute could be used in a sneaky way to override that)
+            self.style.apply(pp)
+            if the_map.affine is not None and 'transform' not in pp.attr:
+                # No need to touch the vertices if the whole projection is affine. The copy keeps its stroke as it
+                # is, rather than have it scaled by the group, and is written with the map's number format.
+                if the_map.scaled:
+                    pp.attr['vector-effect'] = 'non-scaling-stroke'
+                if the_map.precision is not None:
+                    the_map.copy_svg(pp)
+                return pp, the_map.affine != (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+            # long paths have all their points projected in one vectorized call, unless they go through a cache
+            project_many = None
+            if 'project' not in the_map.caches and len(p.pathdata().coordinates) >= 2*self.many_points:
+                project_many = the_map.project_many
+            pp = the_map.path_svg(svgfig_mc.pathtoPath(pp, compact=True), the_map.project, project_many)
+        elif pp.t == 'text':
+            # for texts, we have to consider existing transforms
+            try:
+                x, y = float(pp.attr['x']), float(pp.attr['y'])
+            except KeyError:
+                logger.error('Project.run: skipping text element {} without coordinates.'.format(pp.attr['id']))
+                return None
+            m = svg_get_matrix(get_or_default(pp.attr, 'transform', ''))
+            x0, y0 = m[0]*x + m[2]*y + m[4], m[1]*x + m[3]*y + m[5]
+            if the_map.clip((x0, y0)):
+                return None
+            x1, y1 = the_map.project(x0, y0)
+            m[4] += x1 - x0
+            m[5] += y1 - y0
+            pp.attr['transform'] = 'matrix({:f},{:f},{:f},{:f},{:f},{:f})'.format(*m)
+        elif pp.t == 'g':
+            # For markers, the Symbol class together with svg_transform
+            # does most of the work of sizing, centering and placing the symbol
+            #TODO: change the logic: a symbol is anything that matches the selection criteria
+            x0, y0 = svg_center(pp)
+            if the_map.clip((x0, y0)):
+                return None
+            x1, y1 = the_map.project(x, y)
+            if self.replacement:
+                pp = svg_transform(self.replacement.get_svg(), self.replacement.anchor[0],
+                                   self.replacement.anchor[1], x1, y1, self.replacement.scale,
+                                   self.replacement.scale)
+            else:
+                pp = svg_transform(pp, x, y, x1, y1)
+        return pp, False
 
 
 class Place(Command):
@@ -234,7 +272,7 @@ class Place(Command):
             x, y, d = world[0]
             for w in world[1:]:
                 path = svgfig_mc.Line(x, y, w[0], w[1], **self.line_style.attributes)
-                the_map.add_to_layer(self.target, path.SVG(the_map.project_inner))
+                the_map.add_to_layer(self.target, the_map.path_svg(path, the_map.project_inner))
                 if 'sequential' in self.mode:
                     x, y = w[0], w[1]
 
@@ -400,13 +438,154 @@ class Graticules(Command):
             strings.update({'pos': span*n})
             strings.update(float_to_dms(span*n, self.horizontal, the_map))
             if self.horizontal:
-                the_map.add_to_layer(self.target, l.hline(t).SVG(the_map.project_inner))
+                the_map.add_to_layer(self.target, the_map.path_svg(l.hline(t), the_map.project_inner))
                 if l.labels:
                     x, y = the_map.project_inner(l.pos, t)
                     the_map.add_to_layer(self.target, l.get_label(x, y, strings))
             else:
-                the_map.add_to_layer(self.target, l.vline(t).SVG(the_map.project_inner))
+                the_map.add_to_layer(self.target, the_map.path_svg(l.vline(t), the_map.project_inner))
                 if l.labels:
                     x, y = the_map.project_inner(t, l.pos)
                     the_map.add_to_layer(self.target, l.get_label(x, y, strings))
         logger.info('Graticules.run: drew {} graticules'.format('horizontal' if self.horizontal else 'vertical'))
+
+
+class Reproject(Command):
+    """
+    Reproject a finished map, made by SvgMapper, into this map's projection without going back to its sources.
+    The input file of the map is the earlier output; the map's viewport must be the one that made it, which
+    means giving rect-in and rect-world explicitly, since the scaler is usually not in the output.
+
+    To construct it we need a dictionary of the form
+        {'from': projection, 'viewport': {'center': center, 'scale': scale}, 'layers': [layer, ...]}
+    'from' is the projection that made the input. The optional 'viewport' overrides the center and scale of the
+    map's viewport for the input, if they were different. The optional 'layers' restricts the command to the named
+    layers; otherwise all of them are reprojected into layers of the same name.
+
+    The inverse of the old transform and the new transform are composed into one function of page coordinates,
+    which is applied to all the points of each layer in a single vectorized call. Paths are reprojected point by
+    point. Texts and placed symbols, which are groups with a transform, are moved rather than distorted. The
+    exception are groups whose transform is the old map's own transformation: they hold paths copied by an
+    affine map, so they are dissolved and their transform applied to the paths.
+    """
+    def __init__(self, d):
+        Command.__init__(self, d)
+        try:
+            self.source = d['from']
+        except KeyError as ke:
+            raise MapperException(MX_MISSING_PARAMETER, 'Reproject.__init__', str(ke), 'reproject')
+        self.viewport = get_or_default(d, 'viewport', {})
+        self.layers = get_or_default(d, 'layers', None)
+        self.xs, self.ys, self.points, self.affine = [], [], None, None
+        self.path_svg = None
+        logger.info(u'Loaded Reproject from {}'.format(self.source))
+
+    def run(self, the_map):
+        """ Collect the points of all the layers, reproject them at once, then build the output from them. """
+        projection = the_map.resolve_projection(self.source)
+        if projection is None:
+            raise MapperException(MX_UNRESOLVED_REFERENCE, 'Reproject.run', 'projection', self.source)
+        viewport = the_map.d['viewport']
+        viewport = dict(viewport) if isinstance(viewport, dict) else {}
+        viewport.update(self.viewport)
+        source = the_map.make_transform(projection.initialize(the_map), viewport)
+        self.affine = source.matrix
+        self.path_svg = the_map.path_svg
+
+        self.xs, self.ys = [], []
+        layers = []
+        for s in the_map.input_svg.sub:
+            if isinstance(s, svgfig_mc.SVG) and s.t == 'g' and 'inkscape:groupmode' in s.attr:
+                name = get_or_default(s.attr, 'inkscape:label', get_or_default(s.attr, 'id', self.target))
+                if self.layers is None or name in self.layers:
+                    m = svg_get_matrix(get_or_default(s.attr, 'transform', ''))
+                    layers.append((name, [self.collect(_, m) for _ in s.sub if isinstance(_, svgfig_mc.SVG)]))
+
+        x, y = the_map.project_inner_many(*source.unproject_inner_many(self.xs, self.ys))
+        self.points = iter(zip(x, y))
+        for name, builders in layers:
+            the_map.get_output_layer(name)
+            for build in builders:
+                for s in build():
+                    the_map.add_to_layer(name, s)
+        logger.info(u'Reproject.run: reprojected {} layers, {} points from {}'.format(
+            len(layers), len(self.xs), projection.cls))
+
+    def add_point(self, m, x, y):
+        x, y = m[0]*x + m[2]*y + m[4], m[1]*x + m[3]*y + m[5]
+        self.xs.append(x)
+        self.ys.append(y)
+        return x, y
+
+    def next_point(self, x, y):
+        return self.points.next()
+
+    def collect(self, s, m, dissolved=False):
+        """
+        Record the points of an input element that need projecting, in page coordinates, and return a function
+        that builds the list of output elements once they are projected. m is the transform of the parents,
+        dissolved whether one of them is a dissolved group.
+        """
+        own = svg_get_matrix(get_or_default(s.attr, 'transform', ''))
+        m = matrix_multiply(m, own)
+        if s.t == 'path':
+            p = svgfig_mc.pathtoPath(s, compact=True)
+            p.SVG(lambda x, y: self.add_point(m, x, y))
+
+            def build():
+                pp = self.path_svg(p, self.next_point)
+                if 'transform' in pp.attr:
+                    del pp.attr['transform']
+                if dissolved and pp.attr.get('vector-effect') == 'non-scaling-stroke':
+                    # the copy's guard against the group's scale, which the projected path no longer has
+                    del pp.attr['vector-effect']
+                return [pp]
+            return build
+
+        affine = self.affine is not None and all(abs(a - b) <= 1e-9*(1 + abs(b)) for a, b in zip(own, self.affine))
+        if s.t == 'text' or (s.t == 'g' and 'transform' in s.attr and not affine):
+            if s.t == 'text':
+                try:
+                    x, y = float(s.attr['x']), float(s.attr['y'])
+                except (KeyError, ValueError):
+                    logger.error(u'Reproject.run: skipping text element {} without coordinates.'.format(
+                        get_or_default(s.attr, 'id', '')))
+                    return lambda: []
+            else:
+                try:
+                    x, y = svg_center(s)
+                except TypeError:
+                    # nothing to measure, so anchor the symbol at its origin
+                    x, y = 0.0, 0.0
+            x0, y0 = self.add_point(m, x, y)
+
+            def build():
+                x1, y1 = self.points.next()
+                ss = s.clone(cow=True)
+                ss.attr['transform'] = 'matrix({:f},{:f},{:f},{:f},{:f},{:f})'.format(
+                    m[0], m[1], m[2], m[3], m[4] + x1 - x0, m[5] + y1 - y0)
+                return [ss]
+            return build
+
+        if s.t == 'g':
+            builders = [self.collect(_, m, dissolved or 'transform' in s.attr)
+                        for _ in s.sub if isinstance(_, svgfig_mc.SVG)]
+            if 'transform' in s.attr:
+                # a group made by an affine map: dissolve it, the paths carry its transform now
+                return lambda: [ss for build in builders for ss in build()]
+
+            def build():
+                g = svgfig_mc.SVG('g')
+                g.attr = dict(s.attr)
+                for b in builders:
+                    g.extend(b())
+                return [g]
+            return build
+
+        # anything else is copied as it is, except for the transforms of the dissolved groups
+        def build():
+            ss = s.clone(cow=True)
+            if m != [1., 0., 0., 1., 0., 0.]:
+                ss.attr['transform'] = 'matrix({:f},{:f},{:f},{:f},{:f},{:f})'.format(*m)
+            return [ss]
+        return build
@@ -26,6 +26,12 @@ __author__ = 'Marko Čibej'
 import svgfig_mc
 import logging
 from itertools import chain
+from bisect import bisect_left
+from math import sqrt, sin, cos, atan2, radians, pi
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 logger = logging.getLogger('SvgMapper')
@@ -100,15 +106,170 @@ def matched_only(svg, matcher):
             yield s
 
 
+class ElementIndex:
+    """
+    An inverted index of a svg tree, from tags and from attribute values to elements, for Match to narrow down the
+    elements it tries. Elements are numbered in the order in which MatchIterator visits them, the root first, and
+    each knows where its descendants end, so that the part of the tree below any element is a range of numbers.
+    """
+
+    def __init__(self, svg):
+        self.elements = []
+        self.ends = []
+        self.positions = {}
+        self.tags = {}
+        self.values = {}  # attribute name -> value -> numbers of the elements
+        self.sorted_values = {}  # attribute name -> values in order, made as prefixes are looked up
+        self.add(svg)
+
+    def add(self, s):
+        n = len(self.elements)
+        self.elements.append(s)
+        self.ends.append(None)
+        self.positions[id(s)] = n
+        self.tags.setdefault(s.t, []).append(n)
+        for name, value in s.attr.iteritems():
+            if isinstance(value, basestring):
+                self.values.setdefault(name, {}).setdefault(value, []).append(n)
+        for x in s.sub:
+            if isinstance(x, svgfig_mc.SVG):
+                self.add(x)
+        self.ends[n] = len(self.elements)
+
+    def layer(self, begin, label):
+        """ The first layer with the label below begin, as Match.locate_layer finds it, or None. """
+        lo = self.positions[id(begin)]
+        hi = self.ends[lo]
+        for n in self.values.get('inkscape:label', {}).get(label, []):
+            s = self.elements[n]
+            if lo < n < hi and s.t == 'g' and 'inkscape:groupmode' in s.attr:
+                return s
+        return None
+
+    def literal(self, name, kind, text):
+        """
+        The set of numbers of the elements whose attribute name has a value that is text, as kind says: 'exact',
+        'prefix', 'suffix' or 'substring'. The exact value and the suffix may be followed by a newline, which is
+        what a $ at the end of a regular expression allows.
+        """
+        by_value = self.values.get(name, {})
+        if kind == 'exact':
+            keys = [k for k in (text, text + '\n') if k in by_value]
+        elif kind == 'prefix':
+            if name not in self.sorted_values:
+                self.sorted_values[name] = sorted(by_value)
+            ordered = self.sorted_values[name]
+            keys = []
+            for k in ordered[bisect_left(ordered, text):]:
+                if not k.startswith(text):
+                    break
+                keys.append(k)
+        else:
+            keys = [k for k in by_value if literal_matches(kind, text, k)]
+        found = set()
+        for k in keys:
+            found.update(by_value[k])
+        return found
+
+    def matched(self, start, t, sets, test):
+        """
+        The elements matched_only(start, matcher) finds, for a matcher that takes elements of type t, whose numbers
+        are in all of the sets, and for which test is true.
+        """
+        lo = self.positions[id(start)]
+        hi = self.ends[lo]
+        tagged = self.tags.get(t, [])
+        i, j = bisect_left(tagged, lo), bisect_left(tagged, hi)
+        candidates = tagged[i:j]
+        if sets:
+            smallest = min(sets, key=len)
+            if len(smallest) < len(candidates):
+                candidates = sorted(n for n in smallest if lo <= n < hi and self.elements[n].t == t)
+        found = []
+        skip = lo
+        for n in candidates:
+            # nothing inside a match is looked at
+            if n < skip:
+                continue
+            s = self.elements[n]
+            if all(n in found_set for found_set in sets) and test(s):
+                found.append(s)
+                skip = self.ends[n]
+        return found
+
+
+def element_index(svg):
+    """
+    The ElementIndex of a svg tree. A document, as the loaders make it, keeps it until the tree is changed; for any
+    other element it is built each time.
+    """
+    index = getattr(svg, 'element_index', None)
+    if index is None:
+        index = ElementIndex(svg)
+        if isinstance(svg, svgfig_mc.SVGDocument):
+            svg.element_index = index
+    return index
+
+
+def literal_matches(kind, text, value):
+    """ Whether a value matches a pattern that literal_pattern has taken apart into kind and text. """
+    if kind == 'exact':
+        return value == text or value == text + '\n'
+    elif kind == 'prefix':
+        return value.startswith(text)
+    elif kind == 'suffix':
+        return value.endswith(text) or value.endswith(text + '\n')
+    return text in value
+
+
+def literal_pattern(p):
+    """
+    If the regular expression p, as re.search uses it, looks for plain text, possibly anchored with ^ at the start
+    and $ at the end, return the kind of lookup and the text for ElementIndex.literal. Otherwise return None.
+    """
+    if not isinstance(p, basestring):
+        return None
+    head = p.startswith('^')
+    body = p[1:] if head else p
+    text = []
+    tail = False
+    i = 0
+    while i < len(body):
+        c = body[i]
+        if c == '\\':
+            # an escaped character that isn't a letter or a digit stands for itself
+            if i + 1 == len(body) or body[i + 1].isalnum():
+                return None
+            text.append(body[i + 1])
+            i += 1
+        elif c == '$' and i == len(body) - 1:
+            tail = True
+        elif c in '.^$*+?{}[]|()':
+            return None
+        else:
+            text.append(c)
+        i += 1
+    if head:
+        kind = 'exact' if tail else 'prefix'
+    else:
+        kind = 'suffix' if tail else 'substring'
+    return kind, body[:0].join(text)
+
+
 def svg_center(svg):
     """ Find and return the center of a svg path or group. Only path elements are considered. """
     if svg.t == 'path':
-        bounding_box = path_bounding_box(svgfig_mc.pathtoPath(svg))
+        bounding_box = svg_bounding_box(svg)
     else:
         bounding_box = None
         for i, p in svg:
             if isinstance(p, svgfig_mc.SVG) and p.t == 'path':
-                bounding_box = path_bounding_box(svgfig_mc.pathtoPath(p), start_from=bounding_box)
+                box = svg_bounding_box(p)
+                if bounding_box is None:
+                    bounding_box = box
+                elif None not in box:
+                    bounding_box = (min(bounding_box[0], box[0]), min(bounding_box[1], box[1]),
+                                    max(bounding_box[2], box[2]), max(bounding_box[3], box[3]))
     return (bounding_box[0] + bounding_box[2])/2, (bounding_box[1] + bounding_box[3])/2
 
 
@@ -131,24 +292,264 @@ def svg_get_matrix(trans):
     return [1., 0., 0., 1., 0., 0.]
 
 
+def matrix_multiply(m, n):
+    """ Compose two svg transformation matrices [a, b, c, d, e, f]. The result applies n first, then m. """
+    return [m[0]*n[0] + m[2]*n[1], m[1]*n[0] + m[3]*n[1],
+            m[0]*n[2] + m[2]*n[3], m[1]*n[2] + m[3]*n[3],
+            m[0]*n[4] + m[2]*n[5] + m[4], m[1]*n[4] + m[3]*n[5] + m[5]]
+
+
+def matrix_invert(m):
+    """ Invert an svg transformation matrix [a, b, c, d, e, f]. """
+    det = m[0]*m[3] - m[1]*m[2]
+    a, b, c, d = m[3]/det, -m[1]/det, -m[2]/det, m[0]/det
+    return [a, b, c, d, -a*m[4] - c*m[5], -b*m[4] - d*m[5]]
+
+
+def svg_bounding_box(svg):
+    """
+    The bounding box of a svg path element, as x0, y0, x1, y1. It is measured once per parsed path and kept with
+    the d attribute, so it is measured again only if the d attribute changes.
+    """
+    pd = svg.pathdata()
+    d = svg.attr['d']
+    box = getattr(d, 'bounding_box', None)
+    if box is None:
+        box = path_bounding_box(svgfig_mc.Path(pd))
+        if isinstance(d, svgfig_mc.ParsedText):
+            d.bounding_box = box
+    return box
+
+
 def path_bounding_box(p, start_from=None):
-    """ Measure a svg path and return its bounding box. Only moves and line segments are considered """
-    if start_from is None:
-        x0 = y0 = x1 = y1 = None
-    else:
-        x0, y0, x1, y1 = start_from
-    for dt in p.d:
-        command = dt[0]
-        if command in ("H", "h"):
-            x0, x1 = extend_interval(dt[1], x0, x1)
-        elif command in ("V", "v"):
-            y0, y1 = extend_interval(dt[1], y0, y1)
-        elif command in ("M", "m", "L", "l", "T", "t"):
-            x0, x1 = extend_interval(dt[1], x0, x1)
-            y0, y1 = extend_interval(dt[2], y0, y1)
+    """
+    Measure a svg path and return its bounding box, extended by start_from if given. The whole path grammar is
+    considered: relative commands are resolved the way Path.SVG does it, and curves and arcs are measured at their
+    extremes rather than at their control points. The path data may be a list of tuples or a PathData.
+    """
+    xs, ys, cubics, quadratics = path_points(*path_arrays(p.d))
+    if cubics:
+        ex, ey = bezier_extremes(cubics, 4)
+        xs.extend(ex)
+        ys.extend(ey)
+    if quadratics:
+        ex, ey = bezier_extremes(quadratics, 3)
+        xs.extend(ex)
+        ys.extend(ey)
+    if start_from is not None and start_from[0] is not None:
+        xs.extend((start_from[0], start_from[2]))
+    if start_from is not None and start_from[1] is not None:
+        ys.extend((start_from[1], start_from[3]))
+    x0, x1 = (min(xs), max(xs)) if xs else (None, None)
+    y0, y1 = (min(ys), max(ys)) if ys else (None, None)
     return x0, y0, x1, y1
 
 
+_path_arity = {'Z': 0, 'H': 1, 'V': 1, 'M': 2, 'L': 2, 'T': 2, 'S': 4, 'Q': 4, 'C': 6, 'A': 7}
+
+
+def path_arrays(d):
+    """ The command letters, the numbers and the offsets of path data given as PathData or as a list of tuples. """
+    if isinstance(d, svgfig_mc.PathData):
+        return d.commands, d.coordinates, d.offsets
+    commands, numbers, offsets = [], [], []
+    for dt in d:
+        if dt[0].upper() in _path_arity:
+            # the global flags are dropped; svgfig's ellipse shorthands are not measured
+            commands.append(dt[0])
+            offsets.append(len(numbers))
+            numbers.extend(v for v in dt[1:] if v is not True and v is not False)
+    offsets.append(len(numbers))
+    return ''.join(commands), numbers, offsets
+
+
+def path_points(commands, c, offsets):
+    """
+    Resolve path data into absolute coordinates. Returns the lists of x and y of all the points the path passes
+    through, arc extremes included, and the flat lists of the control polygons of the cubic and quadratic curves.
+    """
+    xs, ys, cubics, quadratics = [], [], [], []
+    x = y = qx = qy = None
+    previous = None
+    for i, command in enumerate(commands):
+        o = offsets[i]
+        kind = command.upper()
+        absolute = command == kind or x is None or y is None
+        if kind == 'Z':
+            # the current point stays where it is, as in Path.SVG
+            previous = kind
+            continue
+        elif kind == 'H':
+            x = c[o] if command == 'H' or x is None else x + c[o]
+            xs.append(x)
+        elif kind == 'V':
+            y = c[o] if command == 'V' or y is None else y + c[o]
+            ys.append(y)
+        elif kind in ('M', 'L'):
+            x, y = (c[o], c[o + 1]) if absolute else (x + c[o], y + c[o + 1])
+            xs.append(x)
+            ys.append(y)
+        elif kind in ('Q', 'T'):
+            if kind == 'Q':
+                cx, cy = (c[o], c[o + 1]) if absolute else (x + c[o], y + c[o + 1])
+                o += 2
+            elif previous in ('Q', 'T'):
+                cx, cy = 2*x - qx, 2*y - qy
+            else:
+                cx, cy = x, y
+            x1, y1 = (c[o], c[o + 1]) if absolute else (x + c[o], y + c[o + 1])
+            if x is not None and y is not None:
+                quadratics.extend((x, cx, x1, y, cy, y1))
+            x, y, qx, qy = x1, y1, cx, cy
+            xs.append(x)
+            ys.append(y)
+        elif kind in ('C', 'S'):
+            if kind == 'C':
+                c1x, c1y = (c[o], c[o + 1]) if absolute else (x + c[o], y + c[o + 1])
+                o += 2
+            elif previous in ('C', 'S'):
+                c1x, c1y = 2*x - qx, 2*y - qy
+            else:
+                c1x, c1y = x, y
+            c2x, c2y = (c[o], c[o + 1]) if absolute else (x + c[o], y + c[o + 1])
+            x1, y1 = (c[o + 2], c[o + 3]) if absolute else (x + c[o + 2], y + c[o + 3])
+            if x is not None and y is not None:
+                cubics.extend((x, c1x, c2x, x1, y, c1y, c2y, y1))
+            x, y, qx, qy = x1, y1, c2x, c2y
+            xs.append(x)
+            ys.append(y)
+        elif kind == 'A':
+            x1, y1 = (c[o + 5], c[o + 6]) if absolute else (x + c[o + 5], y + c[o + 6])
+            if x is not None and y is not None:
+                for ex, ey in arc_extremes(x, y, c[o], c[o + 1], c[o + 2], c[o + 3], c[o + 4], x1, y1):
+                    xs.append(ex)
+                    ys.append(ey)
+            x, y = x1, y1
+            xs.append(x)
+            ys.append(y)
+        previous = kind
+    return xs, ys, cubics, quadratics
+
+
+def bezier_extremes(segments, order):
+    """
+    Find the points where Bézier curves turn in x or in y. The segments are a flat list of x0, x1, ..., y0, y1, ...
+    of the control polygons, with order points each. Uses numpy to do all the curves at once if it is installed.
+    Returns the lists of x and y of the turning points.
+    """
+    if np is not None and len(segments) > 16*order:
+        p = np.array(segments, dtype=float).reshape(-1, 2, order)
+        xs, ys = [], []
+        for k in (0, 1):
+            q = p[:, k, :]
+            for t in _bezier_roots_many(q, order):
+                with np.errstate(invalid='ignore'):
+                    inside = (t > 0.0) & (t < 1.0)
+                if inside.any():
+                    e = _bezier_at_many(p[inside], t[inside], order)
+                    xs.extend(e[:, 0].tolist())
+                    ys.extend(e[:, 1].tolist())
+        return xs, ys
+
+    xs, ys = [], []
+    for i in xrange(0, len(segments), 2*order):
+        px, py = segments[i:i + order], segments[i + order:i + 2*order]
+        for q in (px, py):
+            for t in _bezier_roots(q, order):
+                if 0.0 < t < 1.0:
+                    xs.append(_bezier_at(px, t))
+                    ys.append(_bezier_at(py, t))
+    return xs, ys
+
+
+def _bezier_roots(q, order):
+    """ Parameters at which the derivative of one coordinate of a quadratic or cubic Bézier curve vanishes. """
+    if order == 3:
+        d = q[0] - 2*q[1] + q[2]
+        return [(q[0] - q[1])/d] if d != 0 else []
+    a = -q[0] + 3*q[1] - 3*q[2] + q[3]
+    b = 2*(q[0] - 2*q[1] + q[2])
+    c = q[1] - q[0]
+    if abs(a) < 1e-12*(abs(b) + abs(c) + 1e-300):
+        return [-c/b] if b != 0 else []
+    disc = b*b - 4*a*c
+    if disc < 0:
+        return []
+    disc = sqrt(disc)
+    return [(-b + disc)/(2*a), (-b - disc)/(2*a)]
+
+
+def _bezier_at(q, t):
+    s = 1.0 - t
+    if len(q) == 3:
+        return s*s*q[0] + 2*s*t*q[1] + t*t*q[2]
+    return s*s*s*q[0] + 3*s*s*t*q[1] + 3*s*t*t*q[2] + t*t*t*q[3]
+
+
+def _bezier_roots_many(q, order):
+    """ Vectorized _bezier_roots; roots that don't exist come back as nan. """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if order == 3:
+            return [(q[:, 0] - q[:, 1])/(q[:, 0] - 2*q[:, 1] + q[:, 2])]
+        a = -q[:, 0] + 3*q[:, 1] - 3*q[:, 2] + q[:, 3]
+        b = 2*(q[:, 0] - 2*q[:, 1] + q[:, 2])
+        c = q[:, 1] - q[:, 0]
+        linear = np.abs(a) < 1e-12*(np.abs(b) + np.abs(c) + 1e-300)
+        disc = np.sqrt(b*b - 4*a*c)
+        t1 = np.where(linear, -c/b, (-b + disc)/(2*a))
+        t2 = np.where(linear, np.nan, (-b - disc)/(2*a))
+    return [t1, t2]
+
+
+def _bezier_at_many(p, t, order):
+    """ Vectorized _bezier_at for both coordinates; p has the shape (n, 2, order). """
+    s = (1.0 - t)[:, np.newaxis]
+    t = t[:, np.newaxis]
+    if order == 3:
+        return s*s*p[:, :, 0] + 2*s*t*p[:, :, 1] + t*t*p[:, :, 2]
+    return s*s*s*p[:, :, 0] + 3*s*s*t*p[:, :, 1] + 3*s*t*t*p[:, :, 2] + t*t*t*p[:, :, 3]
+
+
+def arc_extremes(x0, y0, rx, ry, angle, large_arc, sweep, x1, y1):
+    """
+    The points where an elliptical arc, given as in svg path data, turns in x or in y. The arc is converted to
+    its centre parametrization as in the implementation notes of the SVG specification, F.6.5 and F.6.6.
+    """
+    rx, ry = abs(rx), abs(ry)
+    if rx == 0 or ry == 0 or (x0 == x1 and y0 == y1):
+        return []
+    phi = radians(angle)
+    cos_phi, sin_phi = cos(phi), sin(phi)
+    dx, dy = (x0 - x1)/2, (y0 - y1)/2
+    xp, yp = cos_phi*dx + sin_phi*dy, -sin_phi*dx + cos_phi*dy
+    scale = xp*xp/(rx*rx) + yp*yp/(ry*ry)
+    if scale > 1:
+        rx, ry = rx*sqrt(scale), ry*sqrt(scale)
+    num = rx*rx*ry*ry - rx*rx*yp*yp - ry*ry*xp*xp
+    den = rx*rx*yp*yp + ry*ry*xp*xp
+    coef = sqrt(max(0.0, num/den))
+    if bool(large_arc) == bool(sweep):
+        coef = -coef
+    cxp, cyp = coef*rx*yp/ry, -coef*ry*xp/rx
+    cx = cos_phi*cxp - sin_phi*cyp + (x0 + x1)/2
+    cy = sin_phi*cxp + cos_phi*cyp + (y0 + y1)/2
+    theta = atan2((yp - cyp)/ry, (xp - cxp)/rx)
+    delta = atan2((-yp - cyp)/ry, (-xp - cxp)/rx) - theta
+    if sweep and delta < 0:
+        delta += 2*pi
+    elif not sweep and delta > 0:
+        delta -= 2*pi
+
+    points = []
+    tx = atan2(-ry*sin_phi, rx*cos_phi)
+    ty = atan2(ry*cos_phi, rx*sin_phi)
+    for t in (tx, tx + pi, ty, ty + pi):
+        # is t on the arc, going from theta over delta?
+        if (t - theta) % (2*pi) <= delta if delta > 0 else (theta - t) % (2*pi) <= -delta:
+            points.append((cx + rx*cos(t)*cos_phi - ry*sin(t)*sin_phi, cy + rx*cos(t)*sin_phi + ry*sin(t)*cos_phi))
+    return points
+
+
 def extend_interval(t, t_min, t_max):
     """
     Helper function that extends an interval based on the next input value.
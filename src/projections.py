@@ -24,14 +24,17 @@
 __author__ = 'Marko Čibej'
 
 from math import *
+from bisect import bisect_right
 from helper import *
 try:
-    from scipy.interpolate import interp1d
+    import numpy as np
 except ImportError:
-    interp1d = None
+    np = None
 
 
 epsilon = 0.0001
+# how close the forward projection of a numerical inverse must come to the point it was asked for
+inverse_residual = 1e-9
 
 
 def sinc(a):
@@ -40,25 +43,307 @@ def sinc(a):
     else:
         return a/sin(a)
 
-def oblique(x, y, x_p, y_p):
-    #TODO: unroll the Riemann sheets properly, clip and move the overhangs, smooth over the singularities
-    a = sin(y_p)*sin(y) - cos(y_p)*cos(y)*cos(x)
-    y1 = asin(a)
-    if sin(y_p)*cos(y) + cos(y_p)*sin(y)*cos(x)<0:
-        if y > 0:
-            y1 = pi - y1
-        else:
-            y1 = -pi - y1
-    x1 = asin(cos(y)*sin(x)/cos(y1)) - x_p
-
-    if cos(x) < -tan(y1)*cos(y_p)*sin(x):
-        x1 = pi - x1
-    if y1 > pi/2:
-        y1 -= pi
-    if y1 < -pi/2:
-        y1 += pi
 
-    return x1, y1
+def sinc_many(a):
+    """ Vectorized version of sinc. """
+    small = np.abs(a) < epsilon
+    return np.where(small, 1.0, a/np.sin(np.where(small, 1.0, a)))
+
+
+def solve_inverse(f, x_out, y_out, x, y, steps=30):
+    """
+    Find (x, y) such that f(x, y) = (x_out, y_out) by Newton's method, starting from the given guess. The Jacobian is
+    taken numerically, so this works for any projection; those with a closed form inverse don't need it.
+    If the solution doesn't come within inverse_residual of (x_out, y_out), as for a point outside the projected
+    world, a warning is logged and (nan, nan) returned.
+    """
+    h = 1e-7
+    for _ in xrange(steps):
+        fx, fy = f(x, y)
+        ax, ay = f(x + h, y)
+        bx, by = f(x, y + h)
+        j11, j21, j12, j22 = (ax - fx)/h, (ay - fy)/h, (bx - fx)/h, (by - fy)/h
+        det = j11*j22 - j12*j21
+        if det == 0:
+            break
+        dx, dy = fx - x_out, fy - y_out
+        sx, sy = (dx*j22 - dy*j12)/det, (dy*j11 - dx*j21)/det
+        x -= sx
+        y = max(-pi/2, min(pi/2, y - sy))
+        if abs(sx) < 1e-12 and abs(sy) < 1e-12:
+            break
+    fx, fy = f(x, y)
+    if not (abs(fx - x_out) <= inverse_residual and abs(fy - y_out) <= inverse_residual):
+        logger.warn(u'solve_inverse: no convergence for ({}, {}), returning nan'.format(x_out, y_out))
+        return float('nan'), float('nan')
+    return x, y
+
+
+def solve_inverse_many(f, x_out, y_out, x, y, steps=30):
+    """ Vectorized version of solve_inverse. The points that don't converge come back as nan. """
+    h = 1e-7
+    for _ in xrange(steps):
+        fx, fy = f(x, y)
+        ax, ay = f(x + h, y)
+        bx, by = f(x, y + h)
+        j11, j21, j12, j22 = (ax - fx)/h, (ay - fy)/h, (bx - fx)/h, (by - fy)/h
+        det = j11*j22 - j12*j21
+        ok = det != 0
+        det = np.where(ok, det, 1.0)
+        dx, dy = fx - x_out, fy - y_out
+        sx = np.where(ok, (dx*j22 - dy*j12)/det, 0.0)
+        sy = np.where(ok, (dy*j11 - dx*j21)/det, 0.0)
+        x = x - sx
+        y = np.clip(y - sy, -pi/2, pi/2)
+        if np.all((np.abs(sx) < 1e-12) & (np.abs(sy) < 1e-12)):
+            break
+    fx, fy = f(x, y)
+    failed = ~((np.abs(fx - x_out) <= inverse_residual) & (np.abs(fy - y_out) <= inverse_residual))
+    if failed.any():
+        logger.warn(u'solve_inverse_many: no convergence for {} of {} points, returning nan'.format(
+            int(failed.sum()), failed.size))
+        x, y = np.where(failed, np.nan, x), np.where(failed, np.nan, y)
+    return x, y
+
+
+def cubic_spline(xs, ys):
+    """
+    Fit a natural cubic spline through the points (xs, ys). Returns the list of coefficients (a, b, c, d) for each
+    interval, such that on [xs[i], xs[i + 1]] the spline is a + b*t + c*t**2 + d*t**3 with t = x - xs[i].
+    """
+    n = len(xs) - 1
+    h = [xs[i + 1] - xs[i] for i in xrange(n)]
+    # solve the tridiagonal system for the quadratic coefficients
+    mu, z = [0.0]*(n + 1), [0.0]*(n + 1)
+    for i in xrange(1, n):
+        alpha = 3*(ys[i + 1] - ys[i])/h[i] - 3*(ys[i] - ys[i - 1])/h[i - 1]
+        l = 2*(xs[i + 1] - xs[i - 1]) - h[i - 1]*mu[i - 1]
+        mu[i] = h[i]/l
+        z[i] = (alpha - h[i - 1]*z[i - 1])/l
+    c = [0.0]*(n + 1)
+    coefficients = [None]*n
+    for i in xrange(n - 1, -1, -1):
+        c[i] = z[i] - mu[i]*c[i + 1]
+        b = (ys[i + 1] - ys[i])/h[i] - h[i]*(c[i + 1] + 2*c[i])/3
+        coefficients[i] = (ys[i], b, c[i], (c[i + 1] - c[i])/(3*h[i]))
+    return coefficients
+
+
+class Rotation:
+    """
+    A change of aspect: the rotation of the sphere that takes the point (x_pole, y_pole) to the north pole.
+    The rotation is precomputed as a 3x3 matrix acting on unit vectors, so each point costs a couple of
+    trigonometric functions to get in and out of Cartesian coordinates and a matrix product in between.
+
+    This leaves one degree of freedom, a turn around the new pole. It is chosen so that the centre of the map,
+    (0, 0), stays on the new prime meridian; if the centre is itself taken to a pole, the old north pole is put
+    on the new prime meridian instead. Thus Rotation(pi/2, 0) gives the usual transverse aspect, in which the
+    central meridian becomes the equator and the centre of the map stays where it was.
+    """
+    def __init__(self, x_pole, y_pole):
+        z = (cos(y_pole)*cos(x_pole), cos(y_pole)*sin(x_pole), sin(y_pole))
+        # the new x axis: the map centre (1, 0, 0) with the component along the new pole removed
+        x = (1 - z[0]*z[0], -z[0]*z[1], -z[0]*z[2])
+        n = sqrt(x[0]*x[0] + x[1]*x[1] + x[2]*x[2])
+        if n < epsilon:
+            x = (-sin(y_pole)*cos(x_pole), -sin(y_pole)*sin(x_pole), cos(y_pole))
+        else:
+            x = (x[0]/n, x[1]/n, x[2]/n)
+        y = (z[1]*x[2] - z[2]*x[1], z[2]*x[0] - z[0]*x[2], z[0]*x[1] - z[1]*x[0])
+        self.m = x + y + z
+
+    def rotate(self, x, y):
+        m = self.m
+        c = cos(y)
+        u, v, w = c*cos(x), c*sin(x), sin(y)
+        return atan2(m[3]*u + m[4]*v + m[5]*w, m[0]*u + m[1]*v + m[2]*w), \
+            asin(max(-1.0, min(1.0, m[6]*u + m[7]*v + m[8]*w)))
+
+    def rotate_many(self, x, y):
+        m = self.m
+        c = np.cos(y)
+        u, v, w = c*np.cos(x), c*np.sin(x), np.sin(y)
+        return np.arctan2(m[3]*u + m[4]*v + m[5]*w, m[0]*u + m[1]*v + m[2]*w), \
+            np.arcsin(np.clip(m[6]*u + m[7]*v + m[8]*w, -1.0, 1.0))
+
+    def unrotate(self, x, y):
+        """ The inverse rotation. The matrix is orthogonal, so this is just its transpose. """
+        m = self.m
+        c = cos(y)
+        u, v, w = c*cos(x), c*sin(x), sin(y)
+        return atan2(m[1]*u + m[4]*v + m[7]*w, m[0]*u + m[3]*v + m[6]*w), \
+            asin(max(-1.0, min(1.0, m[2]*u + m[5]*v + m[8]*w)))
+
+    def unrotate_many(self, x, y):
+        m = self.m
+        c = np.cos(y)
+        u, v, w = c*np.cos(x), c*np.sin(x), np.sin(y)
+        return np.arctan2(m[1]*u + m[4]*v + m[7]*w, m[0]*u + m[3]*v + m[6]*w), \
+            np.arcsin(np.clip(m[2]*u + m[5]*v + m[8]*w, -1.0, 1.0))
+
+
+class Grid:
+    """
+    A function of (x, y) sampled on a regular grid of nodes over a rectangle and interpolated bilinearly in between.
+    Points outside the rectangle are passed on to the function itself.
+
+    The grid starts coarse and the cells are halved until the interpolation is within tolerance of the function,
+    in both x and y, at the midpoints of the cells and their edges. These are exactly the new nodes of the next
+    finer grid, so each refinement is checked with the samples that the next one needs anyway. The largest
+    deviation found at the chosen density is kept as the error.
+    """
+    start_size = 8
+    max_size = 1024
+
+    def __init__(self, rect, tolerance, f, f_many=None):
+        self.x0, self.y0, self.x1, self.y1 = rect
+        self.f = f
+        self.f_many = f_many if np is not None else None
+        n = self.start_size
+        nodes = self.sample(n)
+        while True:
+            finer = self.sample(2*n)
+            self.error = self.midpoint_error(nodes, finer)
+            if self.error <= tolerance or 2*n >= self.max_size:
+                break
+            n, nodes = 2*n, finer
+        self.n = n
+        self.sx = n/(self.x1 - self.x0)
+        self.sy = n/(self.y1 - self.y0)
+
+        # Each cell stores the coefficients of its bilinear form, in the order
+        #   x = a + b*u + c*v + d*u*v,  y = e + f*u + g*v + h*u*v
+        # with u, v the position within the cell. A flat list of cells is by far the fastest to index per point.
+        # An extra row and column of degenerate cells covers the far edges, so no index needs to be clipped.
+        if self.f_many is not None:
+            coefficients = []
+            for g in nodes:
+                g = np.pad(g, ((0, 1), (0, 1)), 'edge')
+                p00, p10, p01, p11 = g[:-1, :-1], g[:-1, 1:], g[1:, :-1], g[1:, 1:]
+                coefficients += [p00, p10 - p00, p01 - p00, p11 - p10 - p01 + p00]
+            self.cells_many = np.stack([_.ravel() for _ in coefficients], axis=1)
+            self.cells = self.cells_many.tolist()
+        else:
+            self.cells = []
+            for j in xrange(n + 1):
+                for i in xrange(n + 1):
+                    cell = ()
+                    for g in nodes:
+                        i1, j1 = min(i + 1, n), min(j + 1, n)
+                        p00, p10, p01, p11 = g[j][i], g[j][i1], g[j1][i], g[j1][i1]
+                        cell += (p00, p10 - p00, p01 - p00, p11 - p10 - p01 + p00)
+                    self.cells.append(cell)
+            self.cells_many = None
+
+    def sample(self, n):
+        """ Evaluate the function on a grid of (n + 1)² nodes. Returns the x and y values, indexed [row][column]. """
+        xs = [self.x0 + (self.x1 - self.x0)*i/n for i in xrange(n + 1)]
+        ys = [self.y0 + (self.y1 - self.y0)*j/n for j in xrange(n + 1)]
+        if self.f_many is not None:
+            x, y = np.meshgrid(xs, ys)
+            gx, gy = self.f_many(x.ravel(), y.ravel())
+            return np.reshape(gx, x.shape), np.reshape(gy, x.shape)
+        rows = [[self.f(x, y) for x in xs] for y in ys]
+        return [[_[0] for _ in row] for row in rows], [[_[1] for _ in row] for row in rows]
+
+    def midpoint_error(self, coarse, fine):
+        """ Largest distance between the interpolated coarse grid and the nodes of the fine grid. """
+        if self.f_many is not None:
+            e = []
+            for c, f in zip(coarse, fine):
+                e += [np.abs(f[0::2, 1::2] - (c[:, :-1] + c[:, 1:])/2).max(),
+                      np.abs(f[1::2, 0::2] - (c[:-1, :] + c[1:, :])/2).max(),
+                      np.abs(f[1::2, 1::2] - (c[:-1, :-1] + c[:-1, 1:] + c[1:, :-1] + c[1:, 1:])/4).max()]
+            # a function that is undefined somewhere on the grid can't be approximated
+            return float('inf') if np.isnan(e).any() else max(e)
+        e = 0.0
+        for c, f in zip(coarse, fine):
+            n = len(c) - 1
+            for j in xrange(n + 1):
+                for i in xrange(n):
+                    e = max(e, abs(f[2*j][2*i + 1] - (c[j][i] + c[j][i + 1])/2))
+            for j in xrange(n):
+                for i in xrange(n + 1):
+                    e = max(e, abs(f[2*j + 1][2*i] - (c[j][i] + c[j + 1][i])/2))
+                for i in xrange(n):
+                    e = max(e, abs(f[2*j + 1][2*i + 1] - (c[j][i] + c[j][i + 1] + c[j + 1][i] + c[j + 1][i + 1])/4))
+        return e
+
+    def compile(self, scale, clamp=False):
+        """
+        Build the interpolating function for points whose coordinates must first be scaled by (ax, ay, bx, by) to
+        get into the rectangle's frame. The scaling is folded into the conversion to grid units. If clamp is set,
+        points outside the rectangle are moved to its edge instead of being passed on to the function.
+        """
+        ax, ay, bx, by = scale
+        ux, u0 = ax*self.sx, (bx - self.x0)*self.sx
+        vy, v0 = ay*self.sy, (by - self.y0)*self.sy
+        n = float(self.n)
+        row = self.n + 1
+        cells = self.cells
+        exact = self.f
+
+        if clamp:
+            def interpolate(x, y):
+                u = x*ux + u0
+                if u < 0.0:
+                    u = 0.0
+                elif u > n:
+                    u = n
+                v = y*vy + v0
+                if v < 0.0:
+                    v = 0.0
+                elif v > n:
+                    v = n
+                i = int(u)
+                j = int(v)
+                a, b, c, d, e, f, g, h = cells[j*row + i]
+                u -= i
+                v -= j
+                return a + (b + d*v)*u + c*v, e + (f + h*v)*u + g*v
+        else:
+            def interpolate(x, y):
+                u = x*ux + u0
+                v = y*vy + v0
+                if 0.0 <= u <= n and 0.0 <= v <= n:
+                    i = int(u)
+                    j = int(v)
+                    a, b, c, d, e, f, g, h = cells[j*row + i]
+                    u -= i
+                    v -= j
+                    return a + (b + d*v)*u + c*v, e + (f + h*v)*u + g*v
+                return exact(x*ax + bx, y*ay + by)
+        return interpolate
+
+    def interpolate_many(self, x, y, scale, clamp=False):
+        """ Vectorized version of the function built by compile. """
+        ax, ay, bx, by = scale
+        n = self.n
+        u = np.asarray(x, dtype=float)*(ax*self.sx) + (bx - self.x0)*self.sx
+        v = np.asarray(y, dtype=float)*(ay*self.sy) + (by - self.y0)*self.sy
+        if clamp:
+            u = np.minimum(np.maximum(u, 0.0), n)
+            v = np.minimum(np.maximum(v, 0.0), n)
+            inside = None
+        else:
+            inside = (u >= 0) & (u <= n) & (v >= 0) & (v <= n)
+            if inside.all():
+                inside = None
+            else:
+                u = np.where(inside, u, 0.0)
+                v = np.where(inside, v, 0.0)
+        i = u.astype(int)
+        j = v.astype(int)
+        u -= i
+        v -= j
+        a, b, c, d, e, f, g, h = self.cells_many[j*(n + 1) + i].T
+        p = a + (b + d*v)*u + c*v
+        q = e + (f + h*v)*u + g*v
+        if inside is not None:
+            outside = ~inside
+            p[outside], q[outside] = self.f_many(np.asarray(x, dtype=float)[outside]*ax + bx,
+                                                 np.asarray(y, dtype=float)[outside]*ay + by)
+        return p, q
 
 
 class Aitoff:
@@ -69,6 +354,25 @@ class Aitoff:
         a = sinc(acos(cos(y)*cos(x/2)))
         return 2*cos(y)*sin(x/2)*a, sin(y)*a
 
+    def project_many(self, x, y):
+        a = sinc_many(np.arccos(np.clip(np.cos(y)*np.cos(x/2), -1, 1)))
+        return 2*np.cos(y)*np.sin(x/2)*a, np.sin(y)*a
+
+    def unproject(self, x, y):
+        """
+        Aitoff is the equatorial azimuthal equidistant projection of (x/2, y), stretched twice horizontally, so it
+        is inverted through that. The distance from the centre is the angle c.
+        """
+        c = hypot(x/2, y)
+        if c == 0:
+            return 0.0, 0.0
+        return 2*atan2(x/2*sin(c), c*cos(c)), asin(max(-1.0, min(1.0, y*sin(c)/c)))
+
+    def unproject_many(self, x, y):
+        c = np.hypot(x/2, y)
+        r = np.where(c == 0, 1.0, c)
+        return 2*np.arctan2(x/2*np.sin(c), r*np.cos(c)), np.arcsin(np.clip(y*np.sin(c)/r, -1.0, 1.0))
+
 
 class Albers:
     def __init__(self, y_ref, y_0, y_1, d):
@@ -81,6 +385,23 @@ class Albers:
         t = self.n*x
         return r*sin(t), self.r0 - r*cos(t)
 
+    def project_many(self, x, y):
+        r = np.sqrt(self.c - 2*self.n*np.sin(y))/self.n
+        t = self.n*x
+        return r*np.sin(t), self.r0 - r*np.cos(t)
+
+    def unproject(self, x, y):
+        s = copysign(1.0, self.n)
+        r = s*hypot(x, self.r0 - y)
+        t = atan2(s*x, s*(self.r0 - y))
+        return t/self.n, asin(max(-1.0, min(1.0, (self.c - (r*self.n)**2)/(2*self.n))))
+
+    def unproject_many(self, x, y):
+        s = copysign(1.0, self.n)
+        r = s*np.hypot(x, self.r0 - y)
+        t = np.arctan2(s*x, s*(self.r0 - y))
+        return t/self.n, np.arcsin(np.clip((self.c - (r*self.n)**2)/(2*self.n), -1.0, 1.0))
+
 
 class Bonne:
     def __init__(self, y_ref, y_0, y_1, d):
@@ -92,6 +413,29 @@ class Bonne:
         t = x*cos(y)/r
         return r*sin(t), self.coty - r*cos(t)
 
+    def project_many(self, x, y):
+        r = self.coty + self.y1 - y
+        t = x*np.cos(y)/r
+        return r*np.sin(t), self.coty - r*np.cos(t)
+
+    def unproject(self, x, y):
+        s = copysign(1.0, self.y1)
+        r = s*hypot(x, self.coty - y)
+        t = atan2(s*x, s*(self.coty - y))
+        y = self.coty + self.y1 - r
+        c = cos(y)
+        if c == 0:
+            return 0.0, y
+        return t*r/c, y
+
+    def unproject_many(self, x, y):
+        s = copysign(1.0, self.y1)
+        r = s*np.hypot(x, self.coty - y)
+        t = np.arctan2(s*x, s*(self.coty - y))
+        y = self.coty + self.y1 - r
+        c = np.cos(y)
+        return np.where(c != 0, t*r/np.where(c != 0, c, 1.0), 0.0), y
+
 
 class Bottomley:
     def __init__(self, y_ref, y_0, y_1, d):
@@ -105,6 +449,22 @@ class Bottomley:
             t = x*self.sy_ref*sin(r)/r
         return r*sin(t), pi/2 - r*cos(t)
 
+    def project_many(self, x, y):
+        r = pi/2 - y
+        small = np.abs(r) < epsilon
+        t = x*self.sy_ref*np.where(small, 1.0, np.sin(r)/np.where(small, 1.0, r))
+        return r*np.sin(t), pi/2 - r*np.cos(t)
+
+    def unproject(self, x, y):
+        r = hypot(x, pi/2 - y)
+        t = atan2(x, pi/2 - y)
+        return t*sinc(r)/self.sy_ref, pi/2 - r
+
+    def unproject_many(self, x, y):
+        r = np.hypot(x, pi/2 - y)
+        t = np.arctan2(x, pi/2 - y)
+        return t*sinc_many(r)/self.sy_ref, pi/2 - r
+
 
 class Cassini:
     def __init__(self, y_ref, y_0, y_1, d):
@@ -113,23 +473,50 @@ class Cassini:
     def project(self, x, y):
         return asin(cos(y)*sin(x)), atan2(tan(y), cos(x))
 
+    def project_many(self, x, y):
+        return np.arcsin(np.cos(y)*np.sin(x)), np.arctan2(np.tan(y), np.cos(x))
+
+    def unproject(self, x, y):
+        return atan2(tan(x), cos(y)), asin(sin(y)*cos(x))
+
+    def unproject_many(self, x, y):
+        return np.arctan2(np.tan(x), np.cos(y)), np.arcsin(np.sin(y)*np.cos(x))
+
 
 class Cylindrical:
     def __init__(self, y_ref, y_0, y_1, d):
         self.y_ref = y_ref
+        self.affine = None
         variant = get_or_default(d, 'variant', 'Plate-Carree')
         if variant == 'Lambert':
             self.fy = lambda y: sin(y)
+            self.fy_many = lambda y: np.sin(y)
+            self.fy_inverse = lambda y: asin(max(-1.0, min(1.0, y)))
+            self.fy_inverse_many = lambda y: np.arcsin(np.clip(y, -1.0, 1.0))
         elif variant == 'Plate-Carree':
-            self.fy = lambda y: y
+            self.fy = self.fy_many = self.fy_inverse = self.fy_inverse_many = lambda y: y
+            # Plate-Carree is a mere shift, which allows Map to skip projecting vertices altogether
+            self.affine = (1.0, 0.0, 0.0, 1.0, 0.0, -y_ref)
         elif variant == 'Central':
             self.fy = lambda y: tan(y)
+            self.fy_many = lambda y: np.tan(y)
+            self.fy_inverse = lambda y: atan(y)
+            self.fy_inverse_many = lambda y: np.arctan(y)
         else:
             raise MapperException(MX_WRONG_VALUE, 'Cylindrical.__init__', 'variant', variant)
 
     def project(self, x, y):
         return x, self.fy(y - self.y_ref)
 
+    def project_many(self, x, y):
+        return x, self.fy_many(y - self.y_ref)
+
+    def unproject(self, x, y):
+        return x, self.fy_inverse(y) + self.y_ref
+
+    def unproject_many(self, x, y):
+        return x, self.fy_inverse_many(y) + self.y_ref
+
 
 class EquidistantConic:
     def __init__(self, y_ref, y_0, y_1, d):
@@ -142,6 +529,23 @@ class EquidistantConic:
         t = self.n*x
         return r*sin(t), self.r0 - r*cos(t)
 
+    def project_many(self, x, y):
+        r = np.sqrt(self.c - 2*self.n*np.sin(y))/self.n
+        t = self.n*x
+        return r*np.sin(t), self.r0 - r*np.cos(t)
+
+    def unproject(self, x, y):
+        s = copysign(1.0, self.n)
+        r = s*hypot(x, self.r0 - y)
+        t = atan2(s*x, s*(self.r0 - y))
+        return t/self.n, asin(max(-1.0, min(1.0, (self.c - (r*self.n)**2)/(2*self.n))))
+
+    def unproject_many(self, x, y):
+        s = copysign(1.0, self.n)
+        r = s*np.hypot(x, self.r0 - y)
+        t = np.arctan2(s*x, s*(self.r0 - y))
+        return t/self.n, np.arcsin(np.clip((self.c - (r*self.n)**2)/(2*self.n), -1.0, 1.0))
+
 
 class Gnomonic:
     def __init__(self, y_ref, y_0, y_1, d):
@@ -152,6 +556,25 @@ class Gnomonic:
         cc = self.sy*sin(y) + self.cy*cos(y)*cos(x)
         return cos(y)*sin(x)/cc, (self.cy*sin(y) - self.sy*cos(y)*cos(x))/cc
 
+    def project_many(self, x, y):
+        cc = self.sy*np.sin(y) + self.cy*np.cos(y)*np.cos(x)
+        return np.cos(y)*np.sin(x)/cc, (self.cy*np.sin(y) - self.sy*np.cos(y)*np.cos(x))/cc
+
+    def unproject(self, x, y):
+        r = hypot(x, y)
+        if r == 0:
+            return 0.0, asin(self.sy)
+        c = atan(r)
+        return atan2(x*sin(c), r*self.cy*cos(c) - y*self.sy*sin(c)), \
+            asin(max(-1.0, min(1.0, cos(c)*self.sy + y*sin(c)*self.cy/r)))
+
+    def unproject_many(self, x, y):
+        r = np.hypot(x, y)
+        c = np.arctan(r)
+        r = np.where(r == 0, 1.0, r)
+        return np.arctan2(x*np.sin(c), r*self.cy*np.cos(c) - y*self.sy*np.sin(c)), \
+            np.arcsin(np.clip(np.cos(c)*self.sy + y*np.sin(c)*self.cy/r, -1.0, 1.0))
+
 
 class Hammer:
     def __init__(self, y_ref, y_0, y_1, d):
@@ -161,6 +584,18 @@ class Hammer:
         d = sqrt(2/(1 + cos(y)*cos(x/2)))
         return 2*cos(y)*sin(x/2)*d, sin(y)*d
 
+    def project_many(self, x, y):
+        d = np.sqrt(2/(1 + np.cos(y)*np.cos(x/2)))
+        return 2*np.cos(y)*np.sin(x/2)*d, np.sin(y)*d
+
+    def unproject(self, x, y):
+        z = sqrt(max(0.0, 1 - (x/4)**2 - (y/2)**2))
+        return 2*atan2(z*x, 2*(2*z*z - 1)), asin(max(-1.0, min(1.0, z*y)))
+
+    def unproject_many(self, x, y):
+        z = np.sqrt(np.maximum(0.0, 1 - (x/4)**2 - (y/2)**2))
+        return 2*np.arctan2(z*x, 2*(2*z*z - 1)), np.arcsin(np.clip(z*y, -1.0, 1.0))
+
 
 class KavrayskiyVII:
     def __init__(self, y_ref, y_0, y_1, d):
@@ -169,57 +604,150 @@ class KavrayskiyVII:
     def project(self, x, y):
         return 3*x*sqrt(1./3 - (y/pi)**2)/2, y
 
+    def project_many(self, x, y):
+        return 3*x*np.sqrt(1./3 - (y/pi)**2)/2, y
+
+    def unproject(self, x, y):
+        return 2*x/(3*sqrt(1./3 - (y/pi)**2)), y
+
+    def unproject_many(self, x, y):
+        return 2*x/(3*np.sqrt(1./3 - (y/pi)**2)), y
+
 
 class Mercator:
     def __init__(self, y_ref, y_0, y_1, d):
         if 'oblique' in d:
-            self.x_pole, self.y_pole = d['oblique']
-            self.project = self.oblique
+            self.aspect = Rotation(*d['oblique'])
+            self.project, self.unproject = self.oblique, self.oblique_inverse
+            self.project_many, self.unproject_many = self.oblique_many, self.oblique_inverse_many
         elif 'transverse' in d:
-            self.project = self.transverse
+            self.aspect = Rotation(pi/2, 0)
+            self.project, self.unproject = self.oblique, self.oblique_inverse
+            self.project_many, self.unproject_many = self.oblique_many, self.oblique_inverse_many
         else:
-            self.project = self.normal
+            self.project, self.unproject = self.normal, self.normal_inverse
+            self.project_many, self.unproject_many = self.normal_many, self.normal_inverse_many
         self.cutoff = get_or_default(d, 'cutoff', 80)
         self.cutoff *= pi/180
 
-    def transverse(self, x, y):
-        a = cos(y)*sin(x)
-        a = max(min(a, self.cutoff), -self.cutoff)
-        return log((1+a)/(1-a))/2, atan2(tan(y), cos(x))
-
     def oblique(self, x, y):
-        a = sin(self.y_pole)*sin(y) + cos(self.y_pole)*cos(y)*cos(x-self.x_pole)
-        a = max(min(a, self.cutoff), -self.cutoff)
-        return log((1+a)/(1-a))/2, atan2(cos(self.y_pole)*sin(y) - sin(self.y_pole)*cos(y)*cos(x-self.x_pole),
-                                         cos(y)*sin(x-self.x_pole))
+        """ Both the transverse and the oblique Mercator are normal Mercator on the rotated sphere, turned sideways. """
+        x, y = self.normal(*self.aspect.rotate(x, y))
+        return y, -x
 
     def normal(self, x, y):
         y = max(min(y, self.cutoff), -self.cutoff)
         return x, log(tan(pi/4 + y/2))
 
+    def oblique_many(self, x, y):
+        x, y = self.normal_many(*self.aspect.rotate_many(x, y))
+        return y, -x
+
+    def normal_many(self, x, y):
+        y = np.clip(y, -self.cutoff, self.cutoff)
+        return x, np.log(np.tan(pi/4 + y/2))
+
+    def oblique_inverse(self, x, y):
+        return self.aspect.unrotate(*self.normal_inverse(-y, x))
+
+    def normal_inverse(self, x, y):
+        return x, 2*atan(exp(y)) - pi/2
+
+    def oblique_inverse_many(self, x, y):
+        return self.aspect.unrotate_many(*self.normal_inverse_many(-y, x))
+
+    def normal_inverse_many(self, x, y):
+        return x, 2*np.arctan(np.exp(y)) - pi/2
+
+
+def x_minus_sin(x):
+    """ Computes x - sin(x) without the cancellation that plain subtraction suffers from for small x. """
+    if x < 0.5:
+        x2 = x*x
+        return x*x2*(1/6. - x2*(1/120. - x2*(1/5040. - x2*(1/362880. - x2/39916800.))))
+    return x - sin(x)
+
+
+def x_minus_sin_many(x):
+    """ Vectorized version of x_minus_sin. """
+    x2 = x*x
+    series = x*x2*(1/6. - x2*(1/120. - x2*(1/5040. - x2*(1/362880. - x2/39916800.))))
+    return np.where(x < 0.5, series, x - np.sin(x))
+
 
 class Mollweide:
+    """
+    The auxiliary angle theta solves 2θ + sin 2θ = π sin φ. Rather than iterate for each point from scratch, the
+    solution is tabulated once and then looked up.
+
+    The table is kept in terms of the polar distance e = π/2 - |θ|, which satisfies 2e - sin 2e = πw with
+    w = 1 - |sin φ|, sampled at w = t³ for equidistant t. This takes care of the cube-root behaviour of
+    the solution near the poles, so that linear interpolation in t is good to a few parts in a million over
+    the whole range. A fixed number of Newton steps (newton_steps) then polishes the result. With the default
+    table_size = 512 and newton_steps = 1 the maximum error of theta is below 1e-12 radians.
+    """
+    table_size = 512
+    newton_steps = 1
+    _table = None
+
     def __init__(self, y_ref, y_0, y_1, d):
-        pass
+        if Mollweide._table is None:
+            Mollweide._table = [self.solve((float(i)/self.table_size)**3) for i in xrange(self.table_size + 1)]
+        if np is not None:
+            self.table_many = np.array(self._table)
+            self.steps_many = np.linspace(0, 1, self.table_size + 1)
+
+    @staticmethod
+    def solve(w):
+        """ Solve 2e - sin 2e = πw for e by bisection, to full precision. Only used to build the table. """
+        e0, e1 = 0.0, pi/2
+        for _ in xrange(64):
+            e = (e0 + e1)/2
+            if x_minus_sin(2*e) < pi*w:
+                e0 = e
+            else:
+                e1 = e
+        return (e0 + e1)/2
 
     def theta(self, y):
-        if abs(cos(2*y) + 1) < epsilon:
-            return y
-        t0 = t1 = y
-        while True:
-            try:
-                t1 = t0 - (2*t0 + sin(2*t0) - pi*sin(y))/(2 + 2*cos(2*t0))
-            except ValueError:
-                exit()
-            if abs(t1 - t0) < epsilon:
-                break
-            t0 = t1
-        return t1
+        w = 2*sin((pi/2 - abs(y))/2)**2
+        t = w**(1/3.)*self.table_size
+        i = min(int(t), self.table_size - 1)
+        e = self._table[i] + (self._table[i + 1] - self._table[i])*(t - i)
+        for _ in xrange(self.newton_steps):
+            d = 4*sin(e)**2
+            if d > 0:
+                e -= (x_minus_sin(2*e) - pi*w)/d
+        return copysign(pi/2 - e, y)
+
+    def theta_many(self, y):
+        """ Vectorized version of theta. """
+        w = 2*np.sin((pi/2 - np.abs(y))/2)**2
+        e = np.interp(w**(1/3.), self.steps_many, self.table_many)
+        for _ in xrange(self.newton_steps):
+            d = 4*np.sin(e)**2
+            e -= np.where(d > 0, (x_minus_sin_many(2*e) - pi*w)/np.where(d > 0, d, 1.0), 0.0)
+        return np.copysign(pi/2 - e, y)
 
     def project(self, x, y):
         t = self.theta(y)
         return 2*sqrt(2)*x*cos(t)/pi, sqrt(2)*sin(t)
 
+    def project_many(self, x, y):
+        t = self.theta_many(y)
+        return 2*sqrt(2)*x*np.cos(t)/pi, sqrt(2)*np.sin(t)
+
+    def unproject(self, x, y):
+        t = asin(max(-1.0, min(1.0, y/sqrt(2))))
+        c = cos(t)
+        return (pi*x/(2*sqrt(2)*c) if c else 0.0), asin(max(-1.0, min(1.0, (2*t + sin(2*t))/pi)))
+
+    def unproject_many(self, x, y):
+        t = np.arcsin(np.clip(y/sqrt(2), -1.0, 1.0))
+        c = np.cos(t)
+        return np.where(c != 0, pi*x/(2*sqrt(2)*np.where(c != 0, c, 1.0)), 0.0), \
+            np.arcsin(np.clip((2*t + np.sin(2*t))/pi, -1.0, 1.0))
+
 
 class Robinson:
     _a = [0.8487, 0.84751182, 0.84479598, 0.840213, 0.83359314, 0.8257851, 0.814752, 0.80006949, 0.78216192, 0.76060494,
@@ -231,32 +759,72 @@ class Robinson:
           0.9599310885968813, 1.0471975511965976, 1.1344640137963142, 1.2217304763960306, 1.3089969389957472,
           1.3962634015954636, 1.4835298641951802, 1.57079632679]
 
-    def __init__(self, y_ref, y_0, y_1, d):
-        if interp1d:
-            self.interpolate = self.interpolate_quadratic
-            self.inter_a = interp1d(self._y, self._a, 'quadratic', copy=False, assume_sorted=True)
-            self.inter_b = interp1d(self._y, self._b, 'quadratic', copy=False, assume_sorted=True)
-        else:
-            logger.warn("Robinson projection: sciPy not installed, defaulting to linear interpolation.")
-            self.interpolate = self.interpolate_linear
-
-    def interpolate_linear(self, y):
-        i = int(y*36/pi)
-        if i == 18:
-            return self._a[i], self._b[i]
-        else:
-            dy = y*36/pi - float(i)
-            return self._a[i] + (self._a[i + 1] - self._a[i])*dy, self._b[i] + (self._b[i + 1] - self._b[i])*dy
+    _spline = None
 
-    def interpolate_quadratic(self, y):
-        return self.inter_a(y), self.inter_b(y)
+    def __init__(self, y_ref, y_0, y_1, d):
+        if Robinson._spline is None:
+            # Fit the tables mirrored around the equator, so the splines behave there, then keep the northern half
+            y = [-_ for _ in reversed(self._y[1:])] + self._y
+            a = list(reversed(self._a[1:])) + self._a
+            b = [-_ for _ in reversed(self._b[1:])] + self._b
+            Robinson._spline = zip(cubic_spline(y, a)[18:], cubic_spline(y, b)[18:])
+        if np is not None:
+            self.nodes_many = np.array(self._y)
+            self.spline_many = np.array(self._spline)
+            self.b_many = np.array(self._b)
+
+    def interpolate(self, y):
+        """ Evaluate the splines for 0 <= y <= pi/2 """
+        i = min(int(y*36/pi), 17)
+        t = y - self._y[i]
+        (a0, a1, a2, a3), (b0, b1, b2, b3) = self._spline[i]
+        return a0 + t*(a1 + t*(a2 + t*a3)), b0 + t*(b1 + t*(b2 + t*b3))
+
+    def interpolate_many(self, y):
+        """ Vectorized version of interpolate. """
+        i = np.minimum((y*36/pi).astype(int), 17)
+        t = y - self.nodes_many[i]
+        a, b = self.spline_many[i, 0].T, self.spline_many[i, 1].T
+        return a[0] + t*(a[1] + t*(a[2] + t*a[3])), b[0] + t*(b[1] + t*(b[2] + t*b[3]))
 
     def project(self, x, y):
-        """ inter1d is sensitive to out-of-bounds conditions, and it uses higher precision arithmetic internally.
-        To avoid rounding errors around y=pi/2, clip the latitude. """
+        """ The tables end at 1.57079632679, just short of pi/2. Clip the latitude to stay inside them. """
         f_a, f_b = self.interpolate(min(abs(y), 1.57079632679))
         return x*f_a, copysign(f_b, y)
 
+    def project_many(self, x, y):
+        f_a, f_b = self.interpolate_many(np.minimum(np.abs(y), 1.57079632679))
+        return x*f_a, np.copysign(f_b, y)
+
+    def latitude(self, f_b):
+        """
+        Invert the spline for the y coordinate, 0 <= f_b <= 1.3523. The spline is monotonic, so the interval is
+        found in the table and the cubic solved by Newton's method from a linear first guess.
+        """
+        i = min(max(bisect_right(self._b, f_b) - 1, 0), 17)
+        b0, b1, b2, b3 = self._spline[i][1]
+        t = (f_b - self._b[i])/(self._b[i + 1] - self._b[i])*(self._y[i + 1] - self._y[i])
+        for _ in xrange(4):
+            t -= (b0 + t*(b1 + t*(b2 + t*b3)) - f_b)/(b1 + t*(2*b2 + t*3*b3))
+        return self._y[i] + t
+
+    def latitude_many(self, f_b):
+        """ Vectorized version of latitude. """
+        i = np.clip(np.searchsorted(self.b_many, f_b, side='right') - 1, 0, 17)
+        b0, b1, b2, b3 = self.spline_many[i, 1].T
+        t = (f_b - self.b_many[i])/(self.b_many[i + 1] - self.b_many[i])*(self.nodes_many[i + 1] - self.nodes_many[i])
+        for _ in xrange(4):
+            t -= (b0 + t*(b1 + t*(b2 + t*b3)) - f_b)/(b1 + t*(2*b2 + t*3*b3))
+        return self.nodes_many[i] + t
+
+    def unproject(self, x, y):
+        y = copysign(self.latitude(min(abs(y), self._b[-1])), y)
+        return x/self.interpolate(abs(y))[0], y
+
+    def unproject_many(self, x, y):
+        y = np.copysign(self.latitude_many(np.minimum(np.abs(y), self._b[-1])), y)
+        return x/self.interpolate_many(np.abs(y))[0], y
+
 
 class Sinusoidal:
     def __init__(self, y_ref, y_0, y_1, d):
@@ -265,6 +833,17 @@ class Sinusoidal:
     def project(self, x, y):
         return x*cos(y), y
 
+    def project_many(self, x, y):
+        return x*np.cos(y), y
+
+    def unproject(self, x, y):
+        c = cos(y)
+        return (x/c if c else 0.0), y
+
+    def unproject_many(self, x, y):
+        c = np.cos(y)
+        return np.where(c != 0, x/np.where(c != 0, c, 1.0), 0.0), y
+
 
 class WinkelTripel:
     def __init__(self, y_ref, y_0, y_1, d):
@@ -274,6 +853,17 @@ class WinkelTripel:
         a = sinc(acos(cos(y)*cos(x/2)))
         return (x*cos(self.y_ref) + 2*cos(y)*sin(x/2)*a)/2, (y + sin(y)*a)/2
 
+    def project_many(self, x, y):
+        a = sinc_many(np.arccos(np.clip(np.cos(y)*np.cos(x/2), -1, 1)))
+        return (x*cos(self.y_ref) + 2*np.cos(y)*np.sin(x/2)*a)/2, (y + np.sin(y)*a)/2
+
+    def unproject(self, x, y):
+        """ There is no closed form, so solve numerically, starting from the scale at the centre. """
+        return solve_inverse(self.project, x, y, 2*x/(1 + cos(self.y_ref)), max(-pi/2, min(pi/2, y)))
+
+    def unproject_many(self, x, y):
+        return solve_inverse_many(self.project_many, x, y, 2*x/(1 + cos(self.y_ref)), np.clip(y, -pi/2, pi/2))
+
 
 projection_classes = {'Aitoff': Aitoff,
     'Albers': Albers,
@@ -30,6 +30,10 @@ import svgfig_mc
 import re
 from math import pi
 import os
+import hashlib
+import marshal
+import tempfile
+from collections import OrderedDict
 
 
 class Resource:
@@ -113,18 +117,16 @@ class Library(Resource):
         except KeyError as ke:
             raise MapperException(MX_MISSING_PARAMETER, 'Library.__init__', str(ke), self.name or 'library')
         self.path = os.path.join(parent.path, self.path)
+        self.parent = parent
         self.svg = None
         logger.info(u'Loaded library {}'.format(self))
 
     def load_symbol(self, name):
         """ Locates and returns the symbol's svg. """
         if self.svg is None:
-            self.svg = svgfig_mc.load(os.path.join(self.path, self.filename))
-        for k, s in self.svg:
-            if isinstance(s, svgfig_mc.SVG):
-                if 'id' in s.attr and name == s.attr['id']:
-                    return s
-        return None
+            self.svg = self.parent.load_svg(os.path.join(self.path, self.filename))
+        found = self.svg.by_id(name)
+        return found[0] if found else None
 
     def get_symbol(self, name):
         try:
@@ -243,8 +245,7 @@ class Rectangle(Resource):
 
     def bounding_box_svg(self, s):
         """ Measure an svg path and set the rectangle to the bounding box """
-        p = svgfig_mc.pathtoPath(s)
-        self.x0, self.y0, self.x1, self.y1 = path_bounding_box(p)
+        self.x0, self.y0, self.x1, self.y1 = svg_bounding_box(s)
         return self
 
     def orient(self, y_negative=False):
@@ -281,6 +282,9 @@ class Rectangle(Resource):
     def crop(self, x, y):
         return min(max(x, self.x0), self.x1), min(max(y, self.y0), self.y1)
 
+    def crop_many(self, x, y):
+        return np.minimum(np.maximum(x, self.x0), self.x1), np.minimum(np.maximum(y, self.y0), self.y1)
+
     def centerpoint(self):
         return (self.x0 + self.x1)/2, (self.y0 + self.y1)/2
 
@@ -352,6 +356,11 @@ class Projection(Resource):
             'center-y':
             'standard-parallel1':
             'standard-parallel2':
+            'aspect': 'transverse' or [lon, lat] of the point that becomes the pole of the projection, in degrees
+                      from the central meridian; the centre of the map stays on the new central meridian
+            'rotate':
+            'approximate': tolerance in output units; if given, the projection is sampled on a grid over the world
+                           rectangle and interpolated between the nodes instead of being computed for every point
     """
     def __init__(self, d):
         Resource.__init__(self)
@@ -363,7 +372,15 @@ class Projection(Resource):
         except KeyError as ke:
             raise MapperException(MX_MISSING_PARAMETER, 'Projection.__init__', str(ke), self.name or 'projection')
         self.d = d
-        self.align = self.rotate = None
+        try:
+            self.tolerance = get_or_default(d, 'approximate', None)
+            if self.tolerance is not None:
+                self.tolerance = float(self.tolerance)
+        except ValueError:
+            raise MapperException(MX_WRONG_VALUE, 'Projection.__init__', 'approximate', d['approximate'])
+        self.align = self.align_many = self.rotate = None
+        self.unalign = self.unalign_many = self.unrotate = None
+        self.x_central = self.aspect = self.turn = None
         logger.info(u'Loaded projection {}'.format(self))
 
     def initialize(self, the_map):
@@ -402,7 +419,7 @@ class Projection(Resource):
         aspect = get_or_default(self.d, 'aspect', None)
         if isinstance(aspect, basestring):
             if aspect == 'transverse':
-                x_pole, y_pole = [0, 0]
+                x_pole, y_pole = pi/2, 0
             else:
                 raise MapperException(MX_WRONG_VALUE, 'Projection.initialize', 'aspect', aspect)
         elif aspect:
@@ -411,19 +428,35 @@ class Projection(Resource):
                 y_pole = aspect[1]*pi/180
             except:
                 raise MapperException(MX_WRONG_VALUE, 'Projection.initialize', 'aspect', aspect)
+        self.x_central = x_central
         if aspect:
-            self.align = lambda x, y: oblique(x - x_central, y, x_pole, y_pole)
+            self.aspect = Rotation(x_pole, y_pole)
+            self.align = lambda x, y: self.aspect.rotate(x - x_central, y)
+            self.align_many = lambda x, y: self.aspect.rotate_many(x - x_central, y)
+
+            def unalign(x, y):
+                x, y = self.aspect.unrotate(x, y)
+                return x + x_central, y
+
+            def unalign_many(x, y):
+                x, y = self.aspect.unrotate_many(x, y)
+                return x + x_central, y
+            self.unalign, self.unalign_many = unalign, unalign_many
         else:
-            self.align = lambda x, y: (x - x_central, y)
+            self.aspect = None
+            self.align = self.align_many = lambda x, y: (x - x_central, y)
+            self.unalign = self.unalign_many = lambda x, y: (x + x_central, y)
 
         angle = get_or_default(self.d, 'rotate', None)
         if angle is not None:
             angle *= pi/180
             s = sin(angle)
             c = cos(angle)
+            self.turn = c, s
             self.rotate = lambda x, y: (c*x + -s*y, s*x + c*y)
+            self.unrotate = lambda x, y: (c*x + s*y, -s*x + c*y)
         else:
-            self.rotate = None
+            self.turn = self.rotate = self.unrotate = None
 
         return self
 
@@ -435,6 +468,386 @@ class Projection(Resource):
             x, y = self.rotate(x, y)
         return x, y
 
+    def project_many(self, x, y):
+        """
+        Project whole arrays of coordinates in one pass. Without numpy, fall back to projecting the points one by one
+        and return lists instead of arrays.
+        """
+        if np is None:
+            xy = [self.project(*_) for _ in zip(x, y)]
+            return [_[0] for _ in xy], [_[1] for _ in xy]
+        x, y = self.align_many(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        x, y = self.projection.project_many(x, y)
+        if self.rotate:
+            x, y = self.rotate(x, y)
+        return x, y
+
+    def unproject(self, x, y):
+        """ The inverse of project: from projected coordinates back to longitude and latitude in radians. """
+        if self.unrotate:
+            x, y = self.unrotate(x, y)
+        x, y = self.projection.unproject(x, y)
+        return self.unalign(x, y)
+
+    def unproject_many(self, x, y):
+        """ Vectorized version of unproject, with the same fallback as project_many. """
+        if np is None:
+            xy = [self.unproject(*_) for _ in zip(x, y)]
+            return [_[0] for _ in xy], [_[1] for _ in xy]
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        if self.unrotate:
+            x, y = self.unrotate(x, y)
+        x, y = self.projection.unproject_many(x, y)
+        return self.unalign_many(x, y)
+
+
+class Transform:
+    """
+    The complete chain of transformations a map applies to each point, compiled into as few steps as possible.
+
+    Map.project goes from input page coordinates to output page coordinates:
+        scale to world coordinates in radians, optionally crop to the world rectangle, shift to the central meridian,
+        optionally change the aspect, apply the projection proper, optionally rotate and scale to the output page.
+    Map.project_inner does the same, starting from world coordinates in radians.
+    Map.unproject and Map.unproject_inner run the whole chain backwards, except for the cropping, which can't be
+    undone.
+
+    The linear stages on either side of the projection are folded into a single pre- and a single post-affine
+    transform. Crop and aspect are only included if they are configured: the right variant of the pipeline is
+    chosen once, here, so the per-point call does not need to check for them.
+
+    If the projection has a tolerance, the exact pipeline is sampled on a Grid over the world rectangle and the
+    stages from world coordinates onwards are replaced by interpolation. Only points that fall outside the
+    rectangle are still projected exactly.
+
+    The transform copies what it needs from the projection, so it stays valid if the projection is later
+    re-initialized for another map.
+    """
+    def __init__(self, projection, scale_in, scale_out, crop=None, world=None):
+        """
+        :param projection: an initialized Projection
+        :param scale_in: (dx, dy, x0, y0) such that world = (x*dx + x0, y*dy + y0)
+        :param scale_out: (d, x_out0, y_out0, x_out1, y_out1) such that page = (d*(x - x_out0) + x_out1,
+                          d*(y_out0 - y) + y_out1)
+        :param crop: the world rectangle in radians to crop to, or None
+        :param world: the world rectangle in radians, over which the approximation grid is laid out
+        """
+        x_c = projection.x_central
+        dx, dy, x0, y0 = scale_in
+        # the pre-affine stage includes the shift to the central meridian; so do the cropping bounds
+        self.pre = dx, dy, x0 - x_c, y0
+        self.inner = 1.0, 1.0, -x_c, 0.0
+        self.bounds = None if crop is None else (crop.x0 - x_c, crop.y0, crop.x1 - x_c, crop.y1)
+        self.aspect = projection.aspect
+        self.core = projection.projection.project
+        self.core_many = getattr(projection.projection, 'project_many', None)
+        self.core_inverse = projection.projection.unproject
+        self.core_inverse_many = getattr(projection.projection, 'unproject_many', None)
+
+        # rotation followed by output scaling, as an svg matrix(a b c d e f): X = a*x + c*y + e, Y = b*x + d*y + f
+        d, x_out0, y_out0, x_out1, y_out1 = scale_out
+        c, s = projection.turn or (1.0, 0.0)
+        self.post = d*c, -d*s, -d*s, -d*c, x_out1 - d*x_out0, y_out1 + d*y_out0
+        self.post_inverse = matrix_invert(self.post)
+
+        # If neither crop nor aspect are used and the projection itself is affine, so is the whole pipeline
+        core_matrix = getattr(projection.projection, 'affine', None)
+        if self.bounds is None and self.aspect is None and core_matrix is not None:
+            ax, ay, bx, by = self.pre
+            self.matrix = matrix_multiply(self.post, matrix_multiply(core_matrix, [ax, 0.0, 0.0, ay, bx, by]))
+        else:
+            self.matrix = None
+
+        if self.bounds is None and self.aspect is None:
+            self.project, self.project_inner = self.compile(self.pre), self.compile(self.inner)
+        elif self.aspect is None:
+            self.project, self.project_inner = self.compile_crop(self.pre), self.compile_crop(self.inner)
+        else:
+            self.project, self.project_inner = self.compile_aspect(self.pre), self.compile_aspect(self.inner)
+        self.unproject, self.unproject_inner = self.compile_inverse(self.pre), self.compile_inverse(self.inner)
+
+        # An affine pipeline is already as cheap as it gets, there is nothing to gain from a grid
+        self.grid = None
+        if projection.tolerance is not None and world is not None and self.matrix is None:
+            self.scale_in = scale_in
+            exact_many = (lambda x, y: self.run_many(self.inner, x, y)) if self.core_many is not None else None
+            self.grid = Grid(world.rect(), projection.tolerance, self.project_inner, exact_many)
+            self.project, self.project_inner = self.compile_grid(scale_in), self.compile_grid((1.0, 1.0, 0.0, 0.0))
+
+    def compile(self, pre):
+        """ The plain pipeline: affine, projection, affine. """
+        ax, ay, bx, by = pre
+        a, b, c, d, e, f = self.post
+        core = self.core
+
+        def project(x, y):
+            x, y = core(x*ax + bx, y*ay + by)
+            return a*x + c*y + e, b*x + d*y + f
+        return project
+
+    def compile_crop(self, pre):
+        """ The pipeline with cropping to the world rectangle. """
+        ax, ay, bx, by = pre
+        x0, y0, x1, y1 = self.bounds
+        a, b, c, d, e, f = self.post
+        core = self.core
+
+        def project(x, y):
+            x, y = core(min(max(x*ax + bx, x0), x1), min(max(y*ay + by, y0), y1))
+            return a*x + c*y + e, b*x + d*y + f
+        return project
+
+    def compile_aspect(self, pre):
+        """ The pipeline with a change of aspect and optional cropping. """
+        ax, ay, bx, by = pre
+        x0, y0, x1, y1 = self.bounds or (-float('inf'), -float('inf'), float('inf'), float('inf'))
+        rotate = self.aspect.rotate
+        a, b, c, d, e, f = self.post
+        core = self.core
+
+        def project(x, y):
+            x, y = core(*rotate(min(max(x*ax + bx, x0), x1), min(max(y*ay + by, y0), y1)))
+            return a*x + c*y + e, b*x + d*y + f
+        return project
+
+    def compile_inverse(self, pre):
+        """ The pipeline backwards: affine, inverse projection, optional change of aspect back, affine. """
+        ax, ay, bx, by = pre
+        a, b, c, d, e, f = self.post_inverse
+        core = self.core_inverse
+        if self.aspect is None:
+            def unproject(x, y):
+                x, y = core(a*x + c*y + e, b*x + d*y + f)
+                return (x - bx)/ax, (y - by)/ay
+        else:
+            unrotate = self.aspect.unrotate
+
+            def unproject(x, y):
+                x, y = unrotate(*core(a*x + c*y + e, b*x + d*y + f))
+                return (x - bx)/ax, (y - by)/ay
+        return unproject
+
+    def compile_grid(self, scale):
+        """ The approximate pipeline: affine to world coordinates, optional cropping, interpolation. """
+        return self.grid.compile(scale, self.bounds is not None)
+
+    def project_many(self, x, y):
+        """ Vectorized version of project. Returns lists instead of arrays if numpy is not installed. """
+        if self.grid is not None:
+            return self.grid_many(self.scale_in, x, y)
+        return self.run_many(self.pre, x, y)
+
+    def project_inner_many(self, x, y):
+        """ Vectorized version of project_inner. Returns lists instead of arrays if numpy is not installed. """
+        if self.grid is not None:
+            return self.grid_many((1.0, 1.0, 0.0, 0.0), x, y)
+        return self.run_many(self.inner, x, y)
+
+    def grid_many(self, scale, x, y):
+        if self.grid.f_many is None:
+            f = self.project if scale is self.scale_in else self.project_inner
+            xy = [f(*_) for _ in zip(x, y)]
+            return [_[0] for _ in xy], [_[1] for _ in xy]
+        return self.grid.interpolate_many(x, y, scale, self.bounds is not None)
+
+    def run_many(self, pre, x, y):
+        if np is None or self.core_many is None:
+            f = self.project if pre is self.pre else self.project_inner
+            xy = [f(*_) for _ in zip(x, y)]
+            return [_[0] for _ in xy], [_[1] for _ in xy]
+        ax, ay, bx, by = pre
+        x = np.asarray(x, dtype=float)*ax + bx
+        y = np.asarray(y, dtype=float)*ay + by
+        if self.bounds:
+            x = np.minimum(np.maximum(x, self.bounds[0]), self.bounds[2])
+            y = np.minimum(np.maximum(y, self.bounds[1]), self.bounds[3])
+        if self.aspect is not None:
+            x, y = self.aspect.rotate_many(x, y)
+        x, y = self.core_many(x, y)
+        a, b, c, d, e, f = self.post
+        return a*x + c*y + e, b*x + d*y + f
+
+    def unproject_many(self, x, y):
+        """ Vectorized version of unproject. Returns lists instead of arrays if numpy is not installed. """
+        return self.run_inverse_many(self.pre, x, y)
+
+    def unproject_inner_many(self, x, y):
+        """ Vectorized version of unproject_inner. Returns lists instead of arrays if numpy is not installed. """
+        return self.run_inverse_many(self.inner, x, y)
+
+    def run_inverse_many(self, pre, x, y):
+        if np is None or self.core_inverse_many is None:
+            f = self.unproject if pre is self.pre else self.unproject_inner
+            xy = [f(*_) for _ in zip(x, y)]
+            return [_[0] for _ in xy], [_[1] for _ in xy]
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        a, b, c, d, e, f = self.post_inverse
+        x, y = self.core_inverse_many(a*x + c*y + e, b*x + d*y + f)
+        if self.aspect is not None:
+            x, y = self.aspect.unrotate_many(x, y)
+        ax, ay, bx, by = pre
+        return (x - bx)/ax, (y - by)/ay
+
+
+class ProjectionCache:
+    """
+    A bounded cache in front of a point projection function, for inputs in which the same coordinates come up
+    again and again: borders shared by neighbouring polygons, graticule intersections, repeated placements.
+
+    The key is the input point, rounded to a multiple of quantum if one is given; otherwise only exact repeats hit.
+    Eviction approximates LRU with two generations of plain dicts, which is much cheaper per lookup than keeping
+    an exact order: entries are added to the current generation, hits in the older one are promoted, and when the
+    current generation fills up, the older one is dropped as a whole. Memory is thus bounded by size entries.
+    """
+    def __init__(self, f, size, quantum=None):
+        self.f = f
+        self.capacity = max(int(size)//2, 1)
+        self.scale = 1.0/quantum if quantum else None
+        self.current, self.previous = {}, {}
+        self.hits = self.misses = 0
+
+    def project(self, x, y):
+        if self.scale:
+            key = ((x*self.scale + 0.5)//1, (y*self.scale + 0.5)//1)
+        else:
+            key = (x, y)
+        xy = self.current.get(key)
+        if xy is not None:
+            self.hits += 1
+            return xy
+        xy = self.previous.get(key)
+        if xy is None:
+            xy = self.f(x, y)
+            self.misses += 1
+        else:
+            self.hits += 1
+        if len(self.current) >= self.capacity:
+            self.previous, self.current = self.current, {}
+        self.current[key] = xy
+        return xy
+
+    def hit_rate(self):
+        n = self.hits + self.misses
+        return float(self.hits)/n if n else 0.0
+
+
+class DocumentCache:
+    """
+    Parsed svg files, kept so that the maps and libraries that read the same file share a single parse of it.
+    Files are known by their absolute path, and are parsed again when their modification time or size changes.
+    The trees are shared, so they are loaded read-only, as svgfig_mc.ReadOnlySVG elements that raise TypeError on
+    any change: clone whatever needs changing. With neither a budget nor a directory the cache is off, and files
+    are simply loaded, as ordinary svg elements that can be changed.
+
+    Memory is bounded by budget, in bytes, against an estimate of size_factor times the size of the file. This is
+    a rough estimate: measured read-only parses, with the data of their paths parsed as well, take 5 to 7 times the
+    size of the sample and symbol files, and up to 14 times for files of many short paths. When the budget is
+    exceeded, the least recently used documents are dropped; a document larger than the whole budget is not kept.
+
+    If a directory is given, parsed documents are also kept there, together with the parsed data of their paths,
+    in the binary form of svgfig_mc.save_parsed. They are read from there, rather than parsed, for as long as the
+    modification time and size of the file stay the same.
+    """
+    size_factor = 10
+    default_budget = 256*2**20
+
+    def __init__(self, budget, directory=None):
+        self.budget = budget
+        self.directory = directory
+        self.documents = OrderedDict()
+        self.used = 0
+        self.hits = self.misses = self.evictions = 0
+        self.disk_hits = 0
+
+    def load(self, filename):
+        """ Return the parsed file, from the cache if it's there and up to date. """
+        path = os.path.abspath(filename)
+        if not self.active():
+            return svgfig_mc.load(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            # let the loader report it
+            return svgfig_mc.load(path)
+        stamp = (st.st_mtime, st.st_size)
+        entry = self.documents.pop(path, None)
+        if entry is not None:
+            if entry[0] == stamp:
+                # put it back at the most recently used end
+                self.documents[path] = entry
+                self.hits += 1
+                return entry[2]
+            self.used -= entry[1]
+        self.misses += 1
+        svg = self.parse(path, stamp)
+        size = st.st_size*self.size_factor
+        if size <= self.budget:
+            self.documents[path] = (stamp, size, svg)
+            self.used += size
+            while self.used > self.budget:
+                old_path, old = self.documents.popitem(last=False)
+                self.used -= old[1]
+                self.evictions += 1
+                logger.debug(u'DocumentCache.load: dropped {}'.format(old_path))
+        return svg
+
+    def parse(self, path, stamp):
+        """ Parse the file, or read it from the cache directory if it's there and up to date. """
+        if self.directory is None:
+            return svgfig_mc.load(path, read_only=True)
+        key = (path, stamp)
+        name = path.encode('utf-8') if isinstance(path, unicode) else path
+        cached = os.path.join(self.directory, hashlib.md5(name).hexdigest() + '.svgc')
+        try:
+            with open(cached, 'rb') as f:
+                if marshal.load(f) == key:
+                    svg = svgfig_mc.load_parsed(f, read_only=True)
+                    self.disk_hits += 1
+                    return svg
+        except (IOError, EOFError, ValueError, TypeError):
+            # missing, stale or unreadable, so parse the file and replace it
+            pass
+        attributes = []
+        svg = svgfig_mc.load_stream_expat(path, attributes, read_only=True)
+        temporary = None
+        try:
+            # written to a temporary file first, so that an interrupted run can't leave half a file behind
+            fd, temporary = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(key, f)
+                svgfig_mc.save_parsed(svg, attributes, f)
+            # mkstemp makes the file readable by its owner only; give it the mode open would have
+            os.chmod(temporary, 0o666 & ~self.umask())
+            if os.path.exists(cached):
+                os.remove(cached)
+            os.rename(temporary, cached)
+        except (IOError, OSError, ValueError) as e:
+            logger.warn(u'DocumentCache.parse: cannot write {} to the cache: {}'.format(path, e))
+            if temporary is not None and os.path.exists(temporary):
+                os.remove(temporary)
+        return svg
+
+    @staticmethod
+    def umask():
+        """ The process's umask, which can only be read by setting it. """
+        mask = os.umask(0)
+        os.umask(mask)
+        return mask
+
+    def discard(self, filename):
+        """ Forget a file, for instance because it is being written. """
+        entry = self.documents.pop(os.path.abspath(filename), None)
+        if entry is not None:
+            self.used -= entry[1]
+
+    def active(self):
+        return self.budget > 0 or self.directory is not None
+
+    def hit_rate(self):
+        n = self.hits + self.misses
+        return float(self.hits)/n if n else 0.0
+
+
 class Match(Resource):
     """
     Given an SVG type, the name of a layer and/or a set of attribute matches, return the set of matching
@@ -446,17 +859,24 @@ class Match(Resource):
     If only the inner dictionary is present, an anonymous match is created.
 
     If only a single string it given, the result is a match that looks for an element with that id
-    through all layers.
+    through all layers. Like the other patterns, the id is a regular expression that is searched for; if it is
+    plain text that only one id in the document matches, it is looked up in the document's index of ids.
+
+    Given a document with an ElementIndex, a match looks only at the elements of its type in its layer,
+    and answers the patterns that are plain text, anchored or not, from the index.
     """
 
     def __init__(self, d):
         Resource.__init__(self)
         self.name = None
         self.layer = []
+        self.id = None
+        self.literals = {}
         self.is_compiled = False
         if d is None:
             self.pattern = {}
         elif isinstance(d, basestring):
+            self.id = d
             self.pattern = {'id': d}
             self.svg_type = 'path'
         elif isinstance(d, dict):
@@ -478,6 +898,9 @@ class Match(Resource):
     def compile(self):
         """ Build regexp statements for self.pattern """
         for p in self.pattern:
+            literal = literal_pattern(self.pattern[p])
+            if literal is not None:
+                self.literals[p] = literal
             self.pattern[p] = re.compile(self.pattern[p])
         self.is_compiled = True
 
@@ -498,19 +921,124 @@ class Match(Resource):
                     return self.locate_layer(s, layer_iterator)
         return None
 
-    def iter(self, svg_file):
+    def iter(self, svg_file, index=False):
         """
-        Returns an iterator over matching objects.
+        Returns an iterator over matching objects. With index set, an ElementIndex of svg_file is built for this
+        and later matches, if it doesn't have one yet.
         """
         if not self.is_compiled:
             self.compile()
+        if self.id is not None:
+            found = self.find_by_id(svg_file)
+            if found is not None:
+                return iter(found)
+        if index or getattr(svg_file, 'element_index', None) is not None:
+            return self.iter_indexed(element_index(svg_file), svg_file)
         start = self.locate_layer(svg_file, iter(self.layer))
         return matched_only(start, self.does_match)
 
+    def find_by_id(self, svg_file):
+        """
+        Returns what iter would find for a match built from a bare string, looked up in the index of ids of
+        svg_file, or None if the index can't tell: when the id is not plain text, or more than one id or element
+        matches.
+        """
+        if 'id' not in self.literals:
+            return None
+        kind, text = self.literals['id']
+        if self.does_match(svg_file):
+            # matched_only looks at the start first, and then not inside it
+            return [svg_file]
+        ids = [i for i in svg_file.ids() if isinstance(i, basestring) and literal_matches(kind, text, i)]
+        if not ids:
+            return []
+        if len(ids) > 1:
+            return None
+        found = [s for s in svg_file.by_id(ids[0]) if s.t == self.svg_type]
+        return found if len(found) < 2 else None
+
+    def iter_indexed(self, index, svg_file):
+        """
+        Returns an iterator over the same objects as iter, found through the ElementIndex of svg_file.
+        """
+        start = svg_file
+        for label in self.layer:
+            start = index.layer(start, label)
+            if start is None:
+                return iter([])
+        sets = [index.literal(p, kind, text) for p, (kind, text) in self.literals.iteritems()]
+        rest = [(p, r) for p, r in self.pattern.iteritems() if p not in self.literals]
+
+        def test(s):
+            for p, r in rest:
+                if p not in s.attr or r.search(s.attr[p]) is None:
+                    return False
+            return True
+
+        return iter(index.matched(start, self.svg_type, sets, test))
+
+    def stream(self):
+        """
+        Returns a MatchStream, which finds the same objects as iter in a document that is parsed as a stream.
+        """
+        if not self.is_compiled:
+            self.compile()
+        return MatchStream(self)
+
     def does_match(self, s):
-        if s.t != self.svg_type:
+        return self.matches(s.t, s.attr)
+
+    def matches(self, t, attr):
+        if t != self.svg_type:
             return False
         for p in self.pattern:
-            if not p in s.attr or self.pattern[p].search(s.attr[p]) is None:
+            if not p in attr or self.pattern[p].search(attr[p]) is None:
                 return False
-        return True
\ No newline at end of file
+        return True
+
+
+class MatchStream:
+    """
+    Follows a Match through a document that is parsed as a stream, which is seen one element at a time as elements
+    open and close. It finds the same objects as Match.iter, in the same order: first the layer along the layer path,
+    each the first one inside the previous, and then the objects in that layer that match and are not inside another
+    match.
+    """
+
+    def __init__(self, match):
+        self.match = match
+        self.located = []  # depths of the layers found so far along the layer path
+        self.finished = False
+        self.matched_depth = None
+
+    def start(self, name, attr, depth):
+        """
+        Call as an element opens, at depth 0 for the root. Returns True if the element is a match.
+        """
+        if self.finished or self.matched_depth is not None:
+            return False
+        layer = self.match.layer
+        if len(self.located) < len(layer):
+            # locate_layer searches the descendants, so the root is never a layer
+            if depth == 0 or name != 'g' or 'inkscape:groupmode' not in attr or \
+                    attr.get('inkscape:label') != layer[len(self.located)]:
+                return False
+            self.located.append(depth)
+            if len(self.located) < len(layer):
+                return False
+        elif depth == 0:
+            self.located.append(depth)
+        if self.match.matches(name, attr):
+            self.matched_depth = depth
+            return True
+        return False
+
+    def end(self, depth):
+        """
+        Call as an element closes.
+        """
+        if self.matched_depth == depth:
+            self.matched_depth = None
+        if self.located and self.located[-1] == depth:
+            # either the whole layer path has been searched, or a layer on it holds no further layer
+            self.finished = True
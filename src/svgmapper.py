@@ -27,9 +27,13 @@ from commands import *
 from resources import *
 from helper import *
 import svgfig_mc
-from math import pi
+from math import pi, ceil, log10, hypot
 import os
+import copy
+import marshal
+import tempfile
 import traceback
+from collections import OrderedDict
 import yaml
 
 
@@ -39,9 +43,9 @@ class ResourceManager():
     SvgMapper itself. It provides functionality for loading, finding and keeping track of resources.
     """
 
-    top_statements = {'import', 'run', 'map'}
+    top_statements = {'import', 'run', 'map', 'document-cache'}
     resource_statements = {'style', 'match', 'projection', 'unit', 'strings', 'library', 'rectangle'}
-    command_statements = {'project', 'place', 'graticules'}
+    command_statements = {'project', 'place', 'graticules', 'reproject'}
     all_statements = top_statements | resource_statements | command_statements
 
     def __init__(self, parent, path):
@@ -102,6 +106,22 @@ class ResourceManager():
             raise MapperException(MX_UNEXPECTED, 'ResourceManager.add_resource', 'unknown statement', keyword)
         return self
 
+    def load_svg(self, filename):
+        """ Load an svg file through the SvgMapper's document cache. The tree is shared and read-only. """
+        return self.parent.load_svg(filename)
+
+    def discard_svg(self, filename):
+        """ Drop a file that is about to be written from the SvgMapper's document cache. """
+        self.parent.discard_svg(filename)
+
+    def save_output(self, filename, svg, keep=False):
+        """ Write an output file through the SvgMapper, or have it keep the file for a later map to append to. """
+        self.parent.save_output(filename, svg, keep)
+
+    def kept_output(self, filename):
+        """ Return the output file the SvgMapper is keeping, or None if it isn't. """
+        return self.parent.kept_output(filename)
+
     def load(self, filename, path=None, the_filter=None):
         """
         Recursively load a configuration file. Run any import statements as soon as they are encountered and
@@ -324,6 +344,8 @@ class SvgMapper(ResourceManager):
         self.run_list = []
         self.maps = {}
         self.active_config = None
+        self.documents = DocumentCache(0)
+        self.outputs = OrderedDict()
         logger.info(u'SvgMapper.__init__: created mapper')
 
     def __enter__(self):
@@ -377,11 +399,93 @@ class SvgMapper(ResourceManager):
                 if m in self.maps:
                     logger.warn(u'Overwriting map {}.'.format(m))
                 self.maps[m.name] = m
+            elif keyword == 'document-cache':
+                self.set_document_cache(definition)
             elif keyword in self.resource_statements:
                 self.add_resource(keyword, definition)
             else:
                 raise MapperException(MX_UNEXPECTED_PARAMETER, 'SvgMapper.instantiate', keyword, 'main')
 
+    def set_document_cache(self, d):
+        """
+        Turn on the document cache, which is off unless configured. Its memory budget is given in megabytes either
+        alone or as {'budget': budget, 'directory': directory}, the default being DocumentCache.default_budget. A
+        budget of 0 turns the cache off again. The optional directory, which is relative to the config file, keeps
+        parsed documents between runs.
+        """
+        directory = None
+        if isinstance(d, dict):
+            budget = get_or_default(d, 'budget', DocumentCache.default_budget/2.0**20)
+            if 'directory' in d:
+                directory = os.path.join(get_or_default(d, 'path', self.path), d['directory'])
+        else:
+            budget = d
+        try:
+            budget = float(budget)
+        except (TypeError, ValueError):
+            raise MapperException(MX_WRONG_VALUE, 'SvgMapper.set_document_cache', 'document-cache', d)
+        if budget < 0:
+            raise MapperException(MX_WRONG_VALUE, 'SvgMapper.set_document_cache', 'document-cache', d)
+        if directory is not None and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                raise MapperException(MX_WRONG_VALUE, 'SvgMapper.set_document_cache', 'directory', directory)
+        self.documents = DocumentCache(int(budget*2**20), directory)
+
+    def load_svg(self, filename):
+        path = os.path.abspath(filename)
+        if path in self.outputs:
+            # a kept output is read as input, so it must be written out first
+            self.write_output(path, self.outputs.pop(path))
+        return self.documents.load(filename)
+
+    def discard_svg(self, filename):
+        self.documents.discard(filename)
+        self.outputs.pop(os.path.abspath(filename), None)
+
+    def save_output(self, filename, svg, keep=False):
+        """
+        Write the output of a map, or, if keep is set, hold it in memory until either a map replaces it or the
+        run is over. Either way, whatever was kept for the same file is dropped. A map appending to a kept output
+        works on a copy, so that if it breaks off, the output is written as the maps before it left it.
+        """
+        path = os.path.abspath(filename)
+        self.discard_svg(path)
+        if keep:
+            self.outputs[path] = svg
+        else:
+            self.write_output(path, svg)
+
+    def kept_output(self, filename):
+        return self.outputs.get(os.path.abspath(filename))
+
+    def flush_outputs(self):
+        """ Write all the outputs that are still kept. """
+        while self.outputs:
+            path, svg = self.outputs.popitem(last=False)
+            self.write_output(path, svg)
+
+    def write_output(self, path, svg):
+        """
+        Save an svg under a temporary name and then rename it, so that a run that breaks off leaves either the old
+        file or the new one, never a part of it.
+        """
+        temporary = path + '.tmp'
+        try:
+            with open(temporary, 'wb') as f:
+                out = svgfig_mc.open_output(path, fileobj=f)
+                svgfig_mc.SVGWriter(out).document(svg)
+                out.close()
+            if os.name == 'nt' and os.path.exists(path):
+                # rename doesn't replace files on Windows
+                os.remove(path)
+            os.rename(temporary, path)
+        except:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
     def replace_targets(self, lst):
         if isinstance(lst, basestring):
             lst = [lst]
@@ -389,12 +493,26 @@ class SvgMapper(ResourceManager):
 
     def run(self, the_map=None):
         if the_map is None:
-            for m in self.run_list:
-                self.maps[m].run()
+            # an output is kept in memory rather than written while some later map appends to the same file
+            outputs = [self.maps[m].output_file() for m in self.run_list]
+            appending = [bool(get_or_default(self.maps[m].d, 'append', False)) for m in self.run_list]
+            try:
+                for i, m in enumerate(self.run_list):
+                    later = zip(outputs[i + 1:], appending[i + 1:])
+                    self.maps[m].run(outputs[i] is not None and (outputs[i], True) in later)
+            finally:
+                self.flush_outputs()
         elif the_map in self.maps:
             self.maps[the_map].run()
         else:
             raise MapperException(MX_UNRESOLVED_REFERENCE, 'SvgMapper.run', 'map', the_map)
+        d = self.documents
+        if not d.active():
+            return
+        logger.info(u'SvgMapper.run: document cache had {} hits and {} misses, hit rate {:.1%}, {} evicted'.format(
+            d.hits, d.misses, d.hit_rate(), d.evictions))
+        if d.directory is not None:
+            logger.info(u'SvgMapper.run: {} of the misses read from {}'.format(d.disk_hits, d.directory))
 
 
 class Map(ResourceManager):
@@ -405,9 +523,17 @@ class Map(ResourceManager):
         ResourceManager.__init__(self, parent, parent.path)
         self.commands = []
         self.layers_out = {}
-        self.input_svg = self.output_svg = self.file_out = None
+        self.input_svg = self.output_svg = self.file_in = self.file_out = None
+        self.stream = False
+        self.index = False
         self.rect_in = self.rect_world = self.rect_world_rad = None
-        self.projection = self.scale_in = self.scale_out = self.mode = None
+        self.projection = self.transform = self.mode = None
+        self.project = self.project_inner = self.project_many = self.project_inner_many = None
+        self.unproject = self.unproject_inner = self.unproject_many = self.unproject_inner_many = None
+        self.affine, self.scaled, self.affine_precision = None, False, None
+        self.affine_groups = {}
+        self.caches = {}
+        self.precision, self.relative = None, False
         self.dx_in = self.dy_in = self.x0_in = self.y0_in = None
         self.dx_out = self.dy_out = self.x0_out = self.y0_out = None
         try:
@@ -436,20 +562,60 @@ class Map(ResourceManager):
             file_in = self.translate_string(self.d['file-in'])
             file_in = os.path.join(self.path, file_in)
             self.strings['input-file'] = file_in
-            self.input_svg = svgfig_mc.load(file_in)
+            self.file_in = file_in
+            # a streamed map only projects, and reads the input as it goes rather than loading it
+            self.stream = bool(get_or_default(self.d, 'stream', False))
+            if self.stream:
+                for c in self.commands:
+                    if not isinstance(c, Project):
+                        raise MapperException(MX_UNEXPECTED_PARAMETER, 'Map.initialize',
+                                              c.__class__.__name__.lower(), 'streamed map')
+                if get_or_default(self.d, 'append', False):
+                    raise MapperException(MX_UNEXPECTED_PARAMETER, 'Map.initialize', 'append', 'streamed map')
+            else:
+                self.input_svg = self.load_svg(file_in)
+            # matches look elements up in an index of the input, rather than search the whole of it each time
+            self.index = bool(get_or_default(self.d, 'index', False))
+            self.mode = get_or_default(self.d, 'mode', 'keep')
+            if self.mode not in {'keep', 'clip', 'crop'}:
+                raise MapperException(MX_WRONG_VALUE, 'Map.initialize', 'mode', self.mode)
+            # how the projected path data is written: decimal places in output units, and relative commands
+            self.precision = get_or_default(self.d, 'precision', None)
+            self.relative = bool(get_or_default(self.d, 'relative', False))
+            if self.precision is not None:
+                try:
+                    self.precision = int(self.precision)
+                except (TypeError, ValueError):
+                    raise MapperException(MX_WRONG_VALUE, 'Map.initialize', 'precision', self.precision)
+                if self.precision < 0:
+                    raise MapperException(MX_WRONG_VALUE, 'Map.initialize', 'precision', self.precision)
+            elif self.relative:
+                raise MapperException(MX_MISSING_PARAMETER, 'Map.initialize', 'precision', 'relative')
             # define all the layers of transformation between the input and the output file.
             self.set_transforms(self.d['viewport'])
             # and then prepare the output file
             self.file_out = self.translate_string(self.d['file-out'])
             self.file_out = os.path.join(self.path, self.file_out)
             self.strings['output-file'] = self.file_out
-            self.init_output(get_or_default(self.d, 'append', False))
-            self.mode = get_or_default(self.d, 'mode', 'keep')
-            if self.mode not in {'keep', 'clip', 'crop'}:
-                raise MapperException(MX_WRONG_VALUE, 'Map.initialize', 'mode', self.mode)
+            if not self.stream:
+                self.init_output(get_or_default(self.d, 'append', False))
         except KeyError as ke:
             raise MapperException(MX_MISSING_PARAMETER, 'Map.initialize', str(ke), 'map')
 
+    def output_file(self):
+        """
+        The absolute name of the file the map writes, as initialize will find it, or None if it isn't given. The
+        map is not initialized; only the strings of the SvgMapper and those the map defines are looked at.
+        """
+        if 'file-out' not in self.d:
+            return None
+        strings = dict(self.parent.strings)
+        for keyword, definition in inner_pairs(get_or_default(self.d, 'do', [])):
+            if keyword == 'strings':
+                strings.update(definition)
+        file_out = get_or_default(strings, self.d['file-out'], self.d['file-out'])
+        return os.path.abspath(os.path.join(self.path, file_out))
+
     def instantiate(self, d):
         """ Instantiate resources and commands and map them. """
         for keyword, definition in inner_pairs(d['do']):
@@ -462,6 +628,8 @@ class Map(ResourceManager):
                     self.commands.append(Place(definition))
                 if keyword == 'graticules':
                     self.commands.append(Graticules(definition))
+                if keyword == 'reproject':
+                    self.commands.append(Reproject(definition))
             else:
                 raise MapperException(MX_UNEXPECTED_PARAMETER,
                                       'Map.instantiate', name=keyword, value='command/resource')
@@ -480,6 +648,9 @@ class Map(ResourceManager):
             scale to output, center and flip the y coordinate again.
         Projection output size is not normalized, output scale is determined by projecting the corners of the world
         rectangle and scaling them to the output rectangle.
+
+        All of the stages are compiled into a single Transform, whose methods become the map's project,
+        project_inner, their inverses unproject and unproject_inner, and the vectorized counterparts of all four.
         """
         # Preferably, read the in_rect from the scaling object, so start by checking if one is defined
         mtc_name = scaler = None
@@ -491,8 +662,10 @@ class Map(ResourceManager):
         if mtc_name:
             mtc = self.get_match(mtc_name)
             try:
-                scaler = mtc.iter(self.input_svg).next()
+                scaler = self.find_first(mtc)
             except:
+                scaler = None
+            if scaler is None:
                 raise MapperException(MX_MISSING_SVG, 'Map.set_transforms', mtc_name, 'input file')
 
         # Now we can get the input rectangle from one of the two sources
@@ -511,26 +684,97 @@ class Map(ResourceManager):
         self.rect_world_rad = Rectangle(self.rect_world).scale(pi/180)
         self.projection.initialize(self)
 
-        # set the incoming linear transform
+        self.transform = self.make_transform(self.projection, d, self.mode == 'crop')
+        self.project, self.project_inner = self.transform.project, self.transform.project_inner
+        self.project_many, self.project_inner_many = self.transform.project_many, self.transform.project_inner_many
+        self.unproject, self.unproject_inner = self.transform.unproject, self.transform.unproject_inner
+        self.unproject_many = self.transform.unproject_many
+        self.unproject_inner_many = self.transform.unproject_inner_many
+        self.set_cache(get_or_default(self.d, 'cache', None))
+        # Paths are copied rather than projected when the transformation is affine, into a group that applies it.
+        # Unless it is a mere shift, the group also scales the strokes, so the copies get a non-scaling stroke.
+        self.affine, self.scaled, self.affine_precision = None, False, None
+        m = self.transform.matrix
+        if m is not None:
+            # adding 0.0 turns a -0.0 into 0.0
+            linear = tuple(v + 0.0 for v in m[:4])
+            self.scaled = any(abs(a - b) > 1e-9 for a, b in zip(linear, (1.0, 0.0, 0.0, 1.0)))
+            if not self.scaled:
+                linear = (1.0, 0.0, 0.0, 1.0)
+            self.affine = linear + tuple(0.0 if abs(v) <= 1e-9 else v + 0.0 for v in m[4:])
+            logger.info(u'Map {}: the transformation is {}, paths will be copied rather than projected'.format(
+                self.name, 'affine' if self.scaled else 'a shift'))
+            if self.precision is not None:
+                # the copies are written in input units, so they need more decimals if the group enlarges them
+                scale = max(hypot(linear[0], linear[1]), hypot(linear[2], linear[3]))
+                self.affine_precision = max(0, self.precision + int(ceil(log10(scale) - 1e-9)))
+        if self.transform.grid is not None:
+            grid = self.transform.grid
+            logger.info(u'Map {}: projection approximated on a {}x{} grid, estimated error {:.3g} for tolerance {}'.format(
+                self.name, grid.n, grid.n, grid.error, self.projection.tolerance))
+            if grid.error > self.projection.tolerance:
+                logger.warn(u'Map {}: grid size limit reached, the approximation is not within tolerance'.format(
+                    self.name))
+
+    def set_cache(self, d):
+        """
+        Optionally put a ProjectionCache in front of project and project_inner. The cache is defined either by
+        its size alone or as {'size': size, 'quantum': quantum}, quantum being in the units of the coordinates.
+        The vectorized functions are not cached.
+        """
+        self.caches = {}
+        if not d:
+            return
+        if isinstance(d, dict):
+            size = get_or_default(d, 'size', 100000)
+            quantum = get_or_default(d, 'quantum', None)
+        else:
+            size, quantum = d, None
+        try:
+            size = int(size)
+            quantum = float(quantum) if quantum is not None else None
+        except (TypeError, ValueError):
+            raise MapperException(MX_WRONG_VALUE, 'Map.set_cache', 'cache', d)
+        self.caches['project'] = ProjectionCache(self.project, size, quantum)
+        self.caches['project_inner'] = ProjectionCache(self.project_inner, size, quantum)
+        self.project = self.caches['project'].project
+        self.project_inner = self.caches['project_inner'].project
+
+    def make_transform(self, projection, d, crop=False):
+        """
+        Compile the Transform for an initialized projection between the map's input and world rectangles and
+        the output page, as placed by the viewport definition d.
+        """
+        # the incoming linear transform
         dx_in = (self.rect_world_rad.x1 - self.rect_world_rad.x0)/(self.rect_in.x1 - self.rect_in.x0)
         dy_in = (self.rect_world_rad.y1 - self.rect_world_rad.y0)/(self.rect_in.y1 - self.rect_in.y0)
         x0_in = self.rect_world_rad.x0 - self.rect_in.x0*dx_in
         y0_in = self.rect_world_rad.y0 - self.rect_in.y0*dy_in
-        self.scale_in = lambda x, y: (x*dx_in + x0_in, y*dy_in + y0_in)
 
         # and the outgoing one
         x_out1, y_out1 = get_or_default(d, 'center', self.rect_in.centerpoint())
         d_out = get_or_default(d, 'scale', 2/(abs(dx_in) + abs(dy_in)))
-        x_out0, y_out0 = self.projection.project(*self.rect_world_rad.centerpoint())
-        self.scale_out = lambda x, y: (d_out*(x - x_out0) + x_out1, d_out*(y_out0 - y) + y_out1)
+        x_out0, y_out0 = projection.project(*self.rect_world_rad.centerpoint())
+
+        return Transform(projection, (dx_in, dy_in, x0_in, y0_in), (d_out, x_out0, y_out0, x_out1, y_out1),
+                         self.rect_world_rad if crop else None, self.rect_world_rad)
 
     def init_output(self, append):
         """
         Either create a new blank output file that is a copy of the input stripped of content,
         or load an existing one and index it.
         """
-        if append and os.path.isfile(self.file_out):
-            self.output_svg = svgfig_mc.load(self.file_out)
+        self.output_svg = None
+        if append:
+            # from memory if an earlier map left it there, otherwise from the file
+            kept = self.kept_output(self.file_out)
+            if kept is not None:
+                # copied as reading the file back would copy it, so that it doesn't share objects with the input
+                # and the attributes keep the order in which the file would have them
+                self.output_svg = kept.reloaded()
+            elif os.path.isfile(self.file_out):
+                self.output_svg = svgfig_mc.load(self.file_out)
+        if self.output_svg is not None:
             for k, s in self.output_svg:
                 if isinstance(s, svgfig_mc.SVG) and s.t == 'g' and 'inkscape:groupmode' in s.attr:
                     self.layers_out[s.attr['inkscape:label']] = s
@@ -542,11 +786,137 @@ class Map(ResourceManager):
                 if isinstance(s, svgfig_mc.SVG) and s.t not in ['g', 'path']:
                     self.output_svg.append(s.clone())
 
-    def run(self):
+    def run(self, keep=False):
+        """ Run the map. If keep is set, the output is left with the SvgMapper for a later map to append to. """
         self.initialize()
+        if self.stream:
+            self.run_streamed()
+        else:
+            for c in self.commands:
+                c.run(self)
+        for name, cache in sorted(self.caches.items()):
+            logger.info(u'Map {}: {} cache had {} hits and {} misses, hit rate {:.1%}'.format(
+                self.name, name, cache.hits, cache.misses, cache.hit_rate()))
+        if not self.stream:
+            self.save_output(self.file_out, self.output_svg, keep)
+
+    def find_first(self, match):
+        """
+        Return the first object the match finds in the input, or None. A streamed map reads the input only as far
+        as that object.
+        """
+        if not self.stream:
+            for s in match.iter(self.input_svg, self.index):
+                return s
+            return None
+        stream = match.stream()
+        depth = [0]
+        found = []
+
+        def start(name, attr):
+            depth[0] += 1
+            return stream.start(name, attr, depth[0] - 1)
+
+        def end(name, s):
+            depth[0] -= 1
+            if stream.matched_depth == depth[0]:
+                found.append(s)
+                raise StopIteration
+            stream.end(depth[0])
+
+        try:
+            svgfig_mc.parse_stream(self.file_in, start, end)
+        except StopIteration:
+            pass
+        return found[0] if found else None
+
+    def run_streamed(self):
+        """
+        Run the projections without loading the input. Each object is projected as soon as it has been read, and
+        written to a temporary file kept for its command. When the input is done, the output is put together from
+        these, with the layers in the order in which run would have created them.
+        """
         for c in self.commands:
-            c.run(self)
-        self.output_svg.save(self.file_out)
+            c.prepare(self)
+        streams = [c.match.stream() for c in self.commands]
+        spills = [tempfile.TemporaryFile() for c in self.commands]
+        counts = [0]*len(self.commands)
+        header = tempfile.TemporaryFile()
+        header_count = [0]
+        root = svgfig_mc.SVG('svg')
+        stack = []
+
+        def start(name, attr):
+            depth = len(stack)
+            if depth == 0:
+                root.attr = copy.deepcopy(attr)
+            matched = [i for i, m in enumerate(streams) if m.start(name, attr, depth)]
+            # the header, as init_output takes it: the top-level members that are not groups
+            is_header = depth == 1 and name not in ['g', 'path']
+            stack.append((matched, is_header))
+            return is_header or bool(matched)
+
+        def end(name, s):
+            matched, is_header = stack.pop()
+            for m in streams:
+                m.end(len(stack))
+            for i in matched:
+                projected = self.commands[i].project_one(self, s)
+                if projected is not None:
+                    pp, affine = projected
+                    marshal.dump((affine, pp.standalone_fragment()), spills[i])
+                    counts[i] += 1
+            if is_header:
+                marshal.dump(s.clone().standalone_fragment(), header)
+                header_count[0] += 1
+
+        try:
+            svgfig_mc.parse_stream(self.file_in, start, end)
+            layers = []
+            for i, c in enumerate(self.commands):
+                if counts[i] and c.target not in layers:
+                    layers.append(c.target)
+            self.discard_svg(self.file_out)
+            f = svgfig_mc.open_output(root.interpret_fileName(self.file_out))
+            try:
+                w = svgfig_mc.SVGWriter(f)
+                w.write(svgfig_mc.standalone_prolog)
+                if not layers and not header_count[0]:
+                    w.element(root)
+                else:
+                    w.write(root.standalone_start())
+                    header.seek(0)
+                    for k in xrange(header_count[0]):
+                        w.write(marshal.load(header))
+                    for layer in layers:
+                        g = self.make_output_layer(layer)
+                        w.write(g.standalone_start())
+                        t = None
+                        for i, c in enumerate(self.commands):
+                            if c.target != layer:
+                                continue
+                            spills[i].seek(0)
+                            for k in xrange(counts[i]):
+                                affine, text = marshal.load(spills[i])
+                                if affine and t is None:
+                                    t = self.make_affine_group()
+                                    w.write(t.standalone_start())
+                                elif not affine and t is not None:
+                                    w.write(t.standalone_end())
+                                    t = None
+                                w.write(text)
+                        if t is not None:
+                            w.write(t.standalone_end())
+                        w.write(g.standalone_end())
+                    w.write(root.standalone_end())
+                w.flush()
+            finally:
+                f.close()
+        finally:
+            header.close()
+            for spill in spills:
+                spill.close()
+        logger.info(u'Map {}: streamed {} objects to {} layers'.format(self.name, sum(counts), len(layers)))
 
     def clip(self, p):
         """ Rejects paths outside the input rectangle if mode in {'clip', 'crop'} """
@@ -557,19 +927,27 @@ class Map(ResourceManager):
         else:
             return self.rect_in.intersects(p)
 
-    def project_inner(self, x, y):
-        """ Project from world coordinates expressed in radians to page coordinates """
-        if self.mode == 'crop':
-            x, y = self.rect_world_rad.crop(x, y)
-        x, y = self.projection.project(x, y)
-        return self.scale_out(x, y)
-
-    def project(self, x, y):
-        x, y = self.scale_in(x, y)
-        if self.mode == 'crop':
-            x, y = self.rect_world_rad.crop(x, y)
-        x, y = self.projection.project(x, y)
-        return self.scale_out(x, y)
+    def path_svg(self, p, trans, trans_many=None):
+        """
+        Apply trans to a svgfig Path, or to anything that makes one such as a Curve, and return the svg path
+        element, written with the map's precision and relative settings. If trans_many, the vectorized version of
+        trans, is given and numpy is installed, the points of a compact path are transformed in a single call.
+        """
+        if not isinstance(p, svgfig_mc.Path):
+            p, trans, trans_many = p.Path(trans), None, None
+        many = None
+        if trans_many is not None and np is not None:
+            many = lambda x, y: [_.tolist() for _ in trans_many(x, y)]
+        return p.SVG(trans, self.precision, self.relative, many)
+
+    def copy_svg(self, p):
+        """
+        Rewrite the d attribute of an svg path element copied by an affine map with the map's precision and
+        relative settings. Its coordinates are in input units, so the precision is adjusted to give that of the
+        output units after the transformation.
+        """
+        p.attr['d'] = p.pathdata().text(None, self.affine_precision, self.relative)
+        return p
 
     def resolve_projection(self, p):
         """
@@ -591,7 +969,7 @@ class Map(ResourceManager):
         if name in self.layers_out:
             g = self.layers_out[name]
         else:
-            g = svgfig_mc.SVG('g', style="display:inline", inkscape__label=name, id=name, inkscape__groupmode='layer')
+            g = self.make_output_layer(name)
             self.output_svg.append(g)
             self.layers_out[name] = g
         return g
@@ -601,3 +979,27 @@ class Map(ResourceManager):
         g = self.get_output_layer(layer)
         g.append(svg_object)
         return g
+
+    def add_affine(self, layer, svg_object):
+        """
+        Append an untransformed svg object to a named layer, inside a group that applies the map's affine
+        transformation. Consecutive objects share the group; anything else added to the layer in between
+        starts a new one, so the drawing order is preserved.
+        """
+        g = self.get_output_layer(layer)
+        t = self.affine_groups.get(layer)
+        if t is None or not g.sub or g.sub[-1] is not t:
+            t = self.make_affine_group()
+            g.append(t)
+            self.affine_groups[layer] = t
+        t.append(svg_object)
+        return t
+
+    def make_output_layer(self, name):
+        """ Create an empty output layer. """
+        return svgfig_mc.SVG('g', style="display:inline", inkscape__label=name, id=name, inkscape__groupmode='layer')
+
+    def make_affine_group(self):
+        """ Create an empty group that applies the map's affine transformation. """
+        return svgfig_mc.SVG('g', transform='matrix({:.12g},{:.12g},{:.12g},{:.12g},{:.12g},{:.12g})'.format(
+            *self.affine))